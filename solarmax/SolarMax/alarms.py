@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Historique des erreurs (EC00..EC08) et détection des nouvelles alarmes
+
+L'onduleur garde ses neuf dernières erreurs dans EC00..EC08, chacune
+sous la forme date,heure,code[,...] (date YYYMMDD et heure en secondes,
+en hexadécimal comme FDAT). Ces registres sont lus rarement, par leur
+propre groupe de l'ordonnanceur. AlarmHistory compare chaque lecture à
+la dernière connue et ne retourne que les entrées nouvelles; la première
+lecture d'un onduleur sert de référence et ne produit rien, pour ne pas
+republier tout l'historique à chaque démarrage. Un onduleur est identifié
+par son hôte et son numéro; le dernier état connu est gardé dans un
+fichier JSON, sous la clé 'hôte/numéro'.
+'''
+import os, json, datetime, logging
+from .solarmax_fr import alarm_names
+
+logger = logging.getLogger(__name__)
+
+EC_REGISTERS = tuple('EC%02i' % i for i in range(9))
+
+
+def entry_date(date, seconds):
+    try:
+        return datetime.datetime(date >> 16, (date >> 8) & 0xFF, date & 0xFF) + datetime.timedelta(seconds=seconds)
+    except (ValueError, OverflowError):
+        return None
+
+
+def decode_entry(register, entry):
+    '''Événement publiable d'une entrée ECxx (tuple d'entiers)'''
+    event = dict(register=register, raw=list(entry), date=None, code=None, alarms=[])
+    if len(entry) >= 3:
+        date = entry_date(entry[0], entry[1])
+        event['date'] = date.isoformat() if date else None
+        event['code'] = entry[2]
+        event['alarms'] = list(alarm_names(entry[2]))
+    return event
+
+
+class AlarmHistory(object):
+
+    def __init__(self, state_file=None):
+        self.state_file = state_file
+        self.__known = {}           # (hôte, onduleur) -> [entrées ECxx], la plus récente d'abord
+        self.counters = dict(reads=0, events=0, baselines=0)
+        self.load()
+
+    def __repr__(self):
+        return 'AlarmHistory[%i inverters / %s]' % (len(self.__known), self.counters)
+
+    def diff(self, host, inverter, sample):
+        '''Nouvelles entrées de l'historique lu dans sample, en événements, la plus ancienne d'abord'''
+        entries = [(key, tuple(sample[key])) for key in EC_REGISTERS if key in sample]
+        if not entries:
+            return []
+        self.counters['reads'] += 1
+        current = [entry for (_, entry) in entries]
+        known = self.__known.get((host, int(inverter)))
+        if known == current:
+            return []
+        self.__known[(host, int(inverter))] = current
+        self.save()
+        if known is None:
+            self.counters['baselines'] += 1
+            return []
+        # l'historique glisse: une entrée déjà vue à un autre rang n'est pas nouvelle
+        seen = set(known)
+        events = [decode_entry(key, entry) for (key, entry) in entries if entry not in seen and any(entry)]
+        events.reverse()
+        self.counters['events'] += len(events)
+        return events
+
+    def load(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            # les clés sans hôte d'un ancien fichier sont ignorées: nouvelle référence
+            self.__known = {
+                (host, int(inverter)): [tuple(entry) for entry in entries]
+                for ((host, _, inverter), entries) in ((key.rpartition('/'), entries) for (key, entries) in state.items()) if host
+            }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, TypeError) as e:
+            logger.error(f'alarms: état {self.state_file} illisible, ignoré: {e}')
+
+    def save(self):
+        if not self.state_file:
+            return
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump({f'{host}/{inverter}': entries for ((host, inverter), entries) in self.__known.items()}, f)
+        os.replace(self.state_file + '.tmp', self.state_file)
+
+    def stats(self):
+        return dict(self.counters)
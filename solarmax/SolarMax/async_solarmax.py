@@ -0,0 +1,237 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Client SolarMax asyncio
+
+Pendant de SolarMax construit sur les flux asyncio: plusieurs hôtes
+peuvent être interrogés en même temps depuis une seule boucle, chaque
+échange étant borné par les délais de connexion et de lecture.
+'''
+import asyncio, time, logging
+from .solarmax_fr import DEBUG, inverter_types, parse_answer, decode_status, status_values, setting_values, inventory_entry, split_values, QueryCache
+from .codec import decode
+from .framing import MASK_7BIT
+from .connection import Backoff, InverterHealth
+from .instrumentation import Instruments, classify
+from .regcache import merge
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSolarMax(object):
+
+    def __init__(self, host, port, connect_timeout=2, read_timeout=10, frame_cache=None, inventory=None, register_cache=None):
+        self.host = host
+        self.port = port
+        self.frame_cache = frame_cache or QueryCache()
+        self.inventory = inventory
+        self.register_cache = register_cache
+        self.backoff = Backoff()
+        self.health = {}
+        self.instruments = Instruments(host)
+        self.connects = 0
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.__reader = None
+        self.__writer = None
+        self.__lock = asyncio.Lock()
+        self.__inverters = {}
+        self.__inverter_list = []
+        self.__allinverters = False
+
+    def __repr__(self):
+        return 'AsyncSolarMax[%s:%s / connected=%s]' % (self.host, self.port, self.connected())
+
+    def __health(self, inverter):
+        health = self.health.get(inverter)
+        if health is None:
+            health = self.health[inverter] = InverterHealth(inverter)
+        return health
+
+    def available(self, inverter):
+        '''Faux tant qu'un onduleur muet est en attente de sa prochaine tentative'''
+        return self.__health(inverter).ready()
+
+    def connected(self):
+        return self.__writer is not None and not self.__writer.is_closing()
+
+    async def connect(self):
+        await self.close()
+        if not self.backoff.ready():
+            return False
+        DEBUG('establishing connection to %s:%i...' % (self.host, self.port))
+        try:
+            self.__reader, self.__writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.connect_timeout)
+            self.connects += 1
+            self.backoff.success()
+            DEBUG('connected.')
+        except (OSError, asyncio.TimeoutError):
+            DEBUG('connection to %s:%i failed' % (self.host, self.port))
+            self.__reader = self.__writer = None
+            self.__allinverters = False
+            self.backoff.failure()
+        return self.connected()
+
+    def abort(self):
+        '''Ferme sans attendre (requête annulée en cours d'échange)'''
+        writer, self.__reader, self.__writer = self.__writer, None, None
+        if writer is not None:
+            writer.close()
+        return writer
+
+    async def close(self):
+        writer = self.abort()
+        if writer is None:
+            return
+        DEBUG('Closing open connection to %s:%s' % (self.host, self.port))
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    async def __exchange(self, q):
+        DEBUG(self.host, '=>', q)
+        self.__writer.write(q)
+        await self.__writer.drain()
+        frame = await asyncio.wait_for(self.__reader.readuntil(b'}'), self.read_timeout)
+        return frame.translate(MASK_7BIT).decode('ascii')
+
+    async def query(self, idn, values, qtype=100):
+        '''
+            Même contrat que SolarMax.query: (inverter, data) ou None,
+            registres en cache complétés sans trame, lecture trop longue
+            pour une réponse découpée en plusieurs trames.
+        '''
+        if qtype != 100 or type(values) not in [list, tuple]:
+            return await self.__query(idn, values, qtype)
+        chunks = split_values(values)
+        if self.register_cache is None and len(chunks) == 1:
+            return await self.__query(idn, values, qtype)
+        values = list(dict.fromkeys(values))
+        (found, missing) = self.register_cache.get(self.host, idn, values) if self.register_cache is not None else ({}, values)
+        if not missing:
+            return (int(idn), merge(values, found))
+        # une trame par part: une réponse ne dépasse jamais MAX_FRAME_LENGTH
+        sample = {}
+        for chunk in split_values(missing):
+            result = await self.__query(idn, chunk, qtype)
+            if not result:
+                return None
+            if self.register_cache is not None:
+                self.register_cache.update(self.host, result[0], result[1])
+            sample.update(result[1].items())
+        return (result[0], merge(values, found, sample))
+
+    def invalidate(self, inverter=None, keys=None):
+        if self.register_cache is not None:
+            self.register_cache.invalidate(self.host, inverter, keys)
+
+    async def __query(self, idn, values, qtype=100):
+        '''Une réponse manquante ou annulée ferme la connexion, la suivante la rouvre'''
+        q = self.frame_cache.get(idn, values, qtype)
+        health = self.__health(int(idn))
+        async with self.__lock:
+            if not self.connected() and not await self.connect():
+                health.failure('no connection')
+                return None
+            started = time.monotonic()
+            try:
+                answer = await self.__exchange(q)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                DEBUG('WR %i: no answer from %s (%r)' % (idn, self.host, e))
+                self.instruments.error('timeout' if isinstance(e, asyncio.TimeoutError) else 'empty_read')
+                self.__allinverters = False
+                await self.close()
+                health.failure(repr(e))
+                return None
+            except asyncio.CancelledError:
+                # host_timeout du démon: la réponse tardive ne doit pas servir à la requête suivante
+                self.instruments.error('timeout')
+                self.abort()
+                health.failure('timeout')
+                raise
+            elapsed = time.monotonic() - started
+
+        try:
+            (inverter, data) = parse_answer(answer)
+            data = decode(data)
+        except Exception as e:
+            # compté ici, l'appelant ne fait que journaliser
+            self.instruments.error(classify(e))
+            health.failure(str(e))
+            raise
+        self.instruments.observe(int(idn), elapsed)
+        health.success()
+        return (inverter, data)
+
+    def stats(self):
+        return dict(
+            connects=self.connects, reconnects=max(self.connects - 1, 0),
+            inverters={i: h.stats() for (i, h) in self.health.items()}, instruments=self.instruments.snapshot(),
+            registers=self.register_cache.stats() if self.register_cache is not None else None,
+        )
+
+    async def poll(self, inverter, values):
+        result = await self.query(inverter, status_values(values))
+        if not result:
+            return None
+        (inverter, data) = result
+        return (inverter, data) + decode_status(data)
+
+    async def write_setting(self, inverter, data):
+        result = await self.query(inverter, setting_values(data), 200)
+        self.invalidate(inverter, [k.upper() for k in data])
+        return result
+
+    async def status(self, inverter):
+        result = await self.poll(inverter, [])
+        if not result:
+            return ('Offline', 'Offline')
+        return result[2:]
+
+    async def use_inverters(self, list_of):
+        self.__inverter_list = list_of
+        if self.inventory is None:
+            await self.detect_inverters()
+            return
+        cached = self.inventory.get(self.host)
+        self.__inverters = {i: inventory_entry(cached[i]) for i in list_of if i in cached}
+        self.__allinverters = len(self.__inverters) == len(list_of)
+
+    async def revalidate(self, limit=1):
+        if self.inventory is None:
+            return
+        stale = self.inventory.stale(self.host, self.__inverters)
+        if stale:
+            await self.detect_inverters(stale[:limit])
+
+    async def detect_inverters(self, inverters=None):
+        if inverters is None:
+            self.__inverters = {}
+            inverters = self.__inverter_list
+        for inverter in inverters:
+            try:
+                DEBUG('searching for #%i on %s' % (inverter, self.host))
+                self.invalidate(inverter, [ 'ADR', 'TYP', 'PIN' ])
+                (inverter, data) = await self.query(inverter, [ 'ADR', 'TYP', 'PIN' ])
+
+                if data['TYP'] in inverter_types.keys():
+                    self.__inverters[inverter] = inverter_types[data['TYP']].copy()
+                    self.__inverters[inverter]['installed'] = data['PIN']
+                    if self.inventory is not None:
+                        self.inventory.update(self.host, inverter, dict(self.__inverters[inverter], typ=data['TYP']))
+                else:
+                    DEBUG('Unknown inverter type: %s (ID #%i)' % (data['TYP'], data['ADR']))
+
+            except Exception as e:
+                DEBUG('Inverter #%i not found: %s' % (inverter, e))
+
+        self.__allinverters = all(i in self.__inverters for i in self.__inverter_list)
+        if not self.__allinverters:
+            DEBUG('not all inverters found on %s' % self.host)
+
+    async def inverters(self):
+        if not self.__allinverters:
+            await self.detect_inverters([i for i in self.__inverter_list if i not in self.__inverters])
+        return self.__inverters
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Décodage des registres SolarMax piloté par table
+
+Chaque clé de query_types a son décodeur choisi une fois pour toutes
+(échelle, type, unité). Une réponse décodée est un objet Sample compact
+(namedtuple) dont la classe est créée une seule fois par jeu de registres.
+Un Sample s'utilise comme avant: sample['PAC'] ou sample.PAC, dict(sample).
+'''
+import datetime
+from functools import lru_cache
+from collections import namedtuple
+
+
+def _hex(value):
+    return int(value, 16)
+
+
+# SYS, ECxx, FDAT... ne prennent que peu de valeurs distinctes
+@lru_cache(maxsize=256)
+def _hex_tuple(value):
+    return tuple([int(v, 16) for v in value.split(',')])
+
+
+@lru_cache(maxsize=64)
+def _datetime(value):
+    (date, time) = value.split(',', 2)
+    time = int(time, 16)
+    return datetime.datetime(int(date[:3], 16), int(date[3:5], 16), int(date[5:], 16), time // 3600, (time % 3600) // 60, time % 60)
+
+
+def _encode_hex(value):
+    return '%X' % int(value)
+
+
+def _encode_hex_tuple(value):
+    return ','.join('%X' % int(v) for v in value)
+
+
+def _encode_datetime(value):
+    return '%03X%02X%02X,%X' % (value.year, value.month, value.day, value.hour * 3600 + value.minute * 60 + value.second)
+
+
+# largeur maximale d'une valeur encodée: 32 bits en hexa, date YYYMMDD,secondes
+WIDTHS = {int: 8, float: 8, datetime.datetime: 13}
+
+
+class Register(object):
+    __slots__ = ('key', 'scale', 'type', 'unit', 'label', 'width', 'decode', 'encode')
+
+    def __init__(self, key, type=int, scale=1, unit='', label='', fields=4):
+        '''fields: nombre de valeurs d'un registre tuple (SYS: code, paramètre)'''
+        self.key = key
+        self.type = type
+        self.scale = scale
+        self.unit = unit
+        self.label = label
+        self.width = WIDTHS.get(type, 8 * fields + fields - 1)
+        if type is float:
+            self.decode = lambda value: int(value, 16) / scale
+            self.encode = lambda value: '%X' % int(round(value * scale))
+        elif type is tuple:
+            self.decode = _hex_tuple
+            self.encode = _encode_hex_tuple
+        elif type is datetime.datetime:
+            self.decode = _datetime
+            self.encode = _encode_datetime
+        else:
+            self.decode = _hex
+            self.encode = _encode_hex
+
+    def __repr__(self):
+        return 'Register[%s / %s / scale=%s / %s]' % (self.key, self.type.__name__, self.scale, self.unit)
+
+
+registers = {r.key: r for r in [
+    Register('KDY', float, 10, 'kWh', 'Énergie du jour'),
+    Register('KMT', int, 1, 'kWh', 'Énergie du mois'),
+    Register('KYR', int, 1, 'kWh', "Énergie de l'année"),
+    Register('KT0', int, 1, 'kWh', 'Énergie totale'),
+    Register('KHR', int, 1, 'h', 'Heures de fonctionnement'),
+    Register('CAC', int, 1, '', 'Nombre de démarrages'),
+    Register('IL1', float, 100, 'A', 'Intensité AC'),
+    Register('IDC', float, 100, 'A', 'Intensité DC'),
+    Register('TNF', float, 100, 'Hz', 'Fréquence réseau'),
+    Register('UL1', float, 10, 'V', 'Tension AC'),
+    Register('UDC', float, 10, 'V', 'Tension DC'),
+    Register('PAC', float, 2, 'W', 'Puissance AC'),
+    Register('PIN', float, 2, 'W', 'Puissance installée'),
+    Register('PRL', int, 1, '%', 'Puissance relative'),
+    Register('TKK', int, 1, '°C', 'Température'),
+    Register('SAL', int, 1, '', 'Alarmes (masque)'),
+    Register('SYS', tuple, 1, '', 'Status', fields=2),
+    Register('ADR', int, 1, '', 'Adresse'),
+    Register('TYP', int, 1, '', 'Type'),
+    Register('MAC', int, 1, '', 'Adresse MAC'),
+    Register('BDN', int, 1, '', 'Numéro de build'),
+    Register('SWV', int, 1, '', 'Version logicielle'),
+    Register('DIN', int, 1, '', 'DIN'),
+    Register('LAN', int, 1, '', 'Langue'),
+    Register('SDAT', datetime.datetime, 1, '', 'Date système'),
+    Register('FDAT', datetime.datetime, 1, '', 'Date de mise en service'),
+] + [Register('EC%02i' % i, tuple, 1, '', 'Historique erreur %i' % i) for i in range(9)]}
+
+
+def normalize_value(key, value):
+    return registers[key].decode(value)
+
+
+def encode_value(key, value):
+    return registers[key].encode(value)
+
+
+class SampleMixin(object):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._fields
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self._fields
+
+    def items(self):
+        return zip(self._fields, self)
+
+
+_sample_types = {}
+
+
+def sample_type(keys):
+    '''Classe Sample et décodeurs, créés une fois par jeu de registres'''
+    keys = tuple(keys)
+    entry = _sample_types.get(keys)
+    if entry is None:
+        cls = type('Sample', (SampleMixin, namedtuple('Sample', keys)), {'__slots__': ()})
+        entry = _sample_types[keys] = (cls, tuple(registers[k].decode for k in keys))
+    return entry
+
+
+def decode(data):
+    '''dict brut {registre: valeur hexa} de parse_answer -> Sample'''
+    (cls, decoders) = sample_type(data.keys())
+    return cls._make([d(v) for (d, v) in zip(decoders, data.values())])
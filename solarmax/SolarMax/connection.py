@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Connexion persistante par hôte et santé des onduleurs
+
+Connection garde le socket d'un hôte ouvert tant qu'il fonctionne et ne
+le reconstruit qu'après une vraie erreur réseau, avec un délai
+exponentiel et aléatoire (Backoff). Après un délai de lecture dépassé,
+il est rouvert tout de suite: la réponse tardive reste sur l'ancien
+socket. La santé de chaque onduleur (InverterHealth) est suivie à part:
+un onduleur qui dort au crépuscule ne retarde plus les autres.
+'''
+import socket, time, random, logging
+from .framing import FrameReader
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff(object):
+
+    def __init__(self, initial=1.0, maximum=300.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+        self.next_try = 0.0
+
+    def __repr__(self):
+        return 'Backoff[attempts=%i / next in %.1fs]' % (self.attempts, max(self.next_try - time.monotonic(), 0))
+
+    def delay(self):
+        d = min(self.initial * self.factor ** max(self.attempts - 1, 0), self.maximum)
+        # une part aléatoire évite que tous les hôtes retentent en même temps
+        return d * (1 - self.jitter * random.random())
+
+    def failure(self, now=None):
+        self.attempts += 1
+        self.next_try = (now or time.monotonic()) + self.delay()
+
+    def success(self):
+        self.attempts = 0
+        self.next_try = 0.0
+
+    def ready(self, now=None):
+        return (now or time.monotonic()) >= self.next_try
+
+
+class InverterHealth(object):
+
+    def __init__(self, idn, backoff=None):
+        self.idn = idn
+        self.backoff = backoff or Backoff(initial=10.0, maximum=600.0)
+        self.ok = False
+        self.failures = 0
+        self.last_seen = None
+        self.last_error = None
+
+    def __repr__(self):
+        return 'InverterHealth[WR %i / ok=%s / failures=%i]' % (self.idn, self.ok, self.failures)
+
+    def success(self):
+        self.ok = True
+        self.last_seen = time.time()
+        self.last_error = None
+        self.backoff.success()
+
+    def failure(self, error):
+        self.ok = False
+        self.failures += 1
+        self.last_error = error
+        self.backoff.failure()
+
+    def ready(self):
+        return self.ok or self.backoff.ready()
+
+    def stats(self):
+        return dict(ok=self.ok, failures=self.failures, attempts=self.backoff.attempts, last_seen=self.last_seen, last_error=self.last_error)
+
+
+class Connection(object):
+
+    def __init__(self, host, port, connect_timeout=2, read_timeout=10, backoff=None):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.backoff = backoff or Backoff()
+        self.sock = None
+        self.reader = None
+        self.connected_since = None
+        self.connects = 0
+        self.failures = 0
+        self.closed_lifetime = 0.0
+        self.last_lifetime = 0.0
+
+    def __repr__(self):
+        return 'Connection[%s:%s / connected=%s / connects=%i]' % (self.host, self.port, self.connected(), self.connects)
+
+    def connected(self):
+        return self.sock is not None
+
+    def lifetime(self):
+        return time.monotonic() - self.connected_since if self.connected_since else 0.0
+
+    def connect(self):
+        '''Ouvre la connexion si le délai de reconnexion est écoulé'''
+        if self.connected():
+            return True
+        if not self.backoff.ready():
+            return False
+        logger.debug('establishing connection to %s:%i...' % (self.host, self.port))
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.settimeout(self.connect_timeout)
+            s.connect((self.host, self.port))
+            s.settimeout(self.read_timeout)
+        except OSError as e:
+            self.failures += 1
+            self.backoff.failure()
+            logger.debug('connection to %s:%i failed (%s), next try in %.1fs' % (self.host, self.port, e, self.backoff.next_try - time.monotonic()))
+            s.close()
+            return False
+        self.sock = s
+        self.reader = FrameReader(s)
+        self.connected_since = time.monotonic()
+        self.connects += 1
+        self.backoff.success()
+        logger.debug('connected.')
+        return True
+
+    def close(self, reason=''):
+        if self.sock is None:
+            return
+        logger.debug('Closing open connection to %s:%s %s' % (self.host, self.port, reason))
+        self.last_lifetime = self.lifetime()
+        self.closed_lifetime += self.last_lifetime
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+        self.reader = None
+        self.connected_since = None
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def read_frame(self):
+        return self.reader.read_frame()
+
+    def stats(self):
+        return dict(
+            connected=self.connected(),
+            connects=self.connects,
+            reconnects=max(self.connects - 1, 0),
+            failures=self.failures,
+            lifetime=self.lifetime(),
+            last_lifetime=self.last_lifetime,
+            total_lifetime=self.closed_lifetime + self.lifetime(),
+            backoff_attempts=self.backoff.attempts,
+        )
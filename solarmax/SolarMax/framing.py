@@ -0,0 +1,65 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Lecture de trames SolarMax par blocs
+
+Le protocole SolarMax encadre chaque réponse entre '{' et '}'.
+Au lieu d'un recv(1) par caractère, FrameReader lit de gros blocs
+dans un tampon réutilisable et découpe les trames à la volée.
+Les octets qui suivent une trame sont conservés pour la suivante.
+'''
+
+# bit de parité supprimé comme dans l'ancien __read_char (ord(byte) & 0x7F)
+MASK_7BIT = bytes(i & 0x7F for i in range(256))
+
+FRAME_END = ord('}')
+
+
+class FrameReader(object):
+
+    def __init__(self, sock, bufsize=4096):
+        self.sock = sock
+        self.__buf = bytearray(bufsize)
+        self.__view = memoryview(self.__buf)
+        self.__pending = bytearray()
+        self.syscalls = 0
+        self.frames = 0
+
+    def __repr__(self):
+        return 'FrameReader[pending=%i / syscalls=%i / frames=%i]' % (len(self.__pending), self.syscalls, self.frames)
+
+    def pending(self):
+        return len(self.__pending)
+
+    def clear(self):
+        del self.__pending[:]
+
+    def __fill(self):
+        n = self.sock.recv_into(self.__view)
+        self.syscalls += 1
+        if n:
+            self.__pending += bytes(self.__view[:n]).translate(MASK_7BIT)
+        return n
+
+    def read_frame(self):
+        '''
+            Retourne la prochaine trame (str) jusqu'à '}' inclus.
+            En fin de flux, retourne les octets restants (trame incomplète) ou ''.
+            Les exceptions socket (timeout, ...) sont propagées.
+        '''
+        start = 0
+        while True:
+            end = self.__pending.find(FRAME_END, start)
+            if end >= 0:
+                end += 1
+                break
+            start = len(self.__pending)
+            if not self.__fill():
+                end = len(self.__pending)
+                break
+
+        frame = bytes(self.__pending[:end])
+        del self.__pending[:end]
+        if frame:
+            self.frames += 1
+        return frame.decode('ascii')
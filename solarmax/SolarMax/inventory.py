@@ -0,0 +1,60 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Inventaire persistant des onduleurs détectés
+
+Le résultat de la détection (type, puissance installée, description,
+dernière validation) est gardé dans un fichier JSON par hôte et par
+identifiant. Au démarrage, le démon publie tout de suite à partir de
+l'inventaire et ne réinterroge (ADR/TYP/PIN) que les identifiants
+absents ou dont la validation est trop ancienne.
+'''
+import os, json, time, threading, logging
+
+logger = logging.getLogger(__name__)
+
+
+class Inventory(object):
+
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        self.__hosts = {}
+        self.__lock = threading.Lock()
+        self.load()
+
+    def __repr__(self):
+        return 'Inventory[%s / %i hosts]' % (self.path, len(self.__hosts))
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                self.__hosts = json.load(f)
+        except FileNotFoundError:
+            self.__hosts = {}
+        except (OSError, ValueError) as e:
+            logger.error(f'inventaire {self.path} illisible, ignoré: {e}')
+            self.__hosts = {}
+
+    def save(self):
+        with self.__lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.__hosts, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+    def get(self, host):
+        '''{inverter: {'desc', 'max', 'installed', 'last_seen'}} de cet hôte'''
+        return {int(idn): dict(entry) for (idn, entry) in self.__hosts.get(host, {}).items()}
+
+    def update(self, host, inverter, entry):
+        entry = dict(entry, last_seen=time.time())
+        with self.__lock:
+            self.__hosts.setdefault(host, {})[str(inverter)] = entry
+        self.save()
+
+    def stale(self, host, inverters, now=None):
+        '''Identifiants absents de l'inventaire ou validés il y a plus de ttl secondes'''
+        now = now or time.time()
+        known = self.__hosts.get(host, {})
+        return [i for i in inverters if now - known.get(str(i), {}).get('last_seen', 0) > self.ttl]
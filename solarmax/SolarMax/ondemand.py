@@ -0,0 +1,260 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Lectures et écritures à la demande (MQTT topic_base/<inv>/get et /set)
+
+Les demandes arrivent dans le thread réseau de paho alors que la
+connexion aux onduleurs appartient à la boucle d'interrogation.
+OnDemandReader répond d'abord depuis RegisterCache (valeurs lues depuis
+moins de ttl secondes, y compris par l'interrogation régulière) et met
+le reste en attente. Les demandes en attente pour un même onduleur sont
+fusionnées: une seule trame pour l'union des registres, chaque demandeur
+reçoit sa part. La boucle d'interrogation les sert entre deux hôtes, une
+trame à la fois, et pendant son attente entre deux cycles.
+
+OnDemandWriter fusionne de même les écritures en attente pour un onduleur
+(la dernière valeur d'un registre l'emporte) et n'envoie pas plus d'une
+trame d'écriture par onduleur toutes les 'interval' secondes: une rafale
+de /set ne prend pas la place de la télémesure. Les registres confirmés
+par l'onduleur sont retirés du cache. Aucun registre n'est modifiable
+tant que la configuration n'en donne pas la liste (ondemand.writable).
+'''
+import time, datetime, threading, logging
+from collections import OrderedDict
+from .codec import registers
+from .instrumentation import Histogram
+
+logger = logging.getLogger(__name__)
+
+
+def jsonable(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+class Demand(object):
+    '''Demandes en attente pour un onduleur, servies par une seule trame'''
+    __slots__ = ('host', 'inverter', 'values', 'waiters')
+
+    def __init__(self, host, inverter):
+        self.host = host
+        self.inverter = inverter
+        self.values = OrderedDict()
+        self.waiters = []
+
+    def __repr__(self):
+        return 'Demand[%s WR %i / %s / %i waiters]' % (self.host, self.inverter, ','.join(self.values), len(self.waiters))
+
+
+class OnDemandReader(object):
+
+    def __init__(self, cache, reply, max_registers=16, wakeup=None):
+        '''reply(host, inverter, payload): publication de la réponse'''
+        self.cache = cache
+        self.reply = reply
+        self.max_registers = max_registers
+        self.wakeup = wakeup or threading.Event()
+        self.__lock = threading.Lock()
+        self.__pending = OrderedDict()      # (hôte, onduleur) -> Demand
+        self.counters = dict(requests=0, from_cache=0, coalesced=0, frames=0, failures=0, rejected=0)
+
+    def __repr__(self):
+        return 'OnDemandReader[%i pending / %s]' % (len(self.__pending), self.counters)
+
+    def request(self, host, inverter, values, request_id=None):
+        '''Appelée depuis le thread mqtt; ne touche jamais au bus'''
+        values = [v.upper() for v in (values.split(',') if isinstance(values, str) else values)]
+        unknown = [v for v in values if v not in registers]
+        error = None
+        if unknown:
+            error = f'registres inconnus: {unknown}'
+        elif not values or len(values) > self.max_registers:
+            error = f'de 1 à {self.max_registers} registres'
+        with self.__lock:
+            # compteurs partagés avec la boucle d'interrogation (complete)
+            self.counters['requests'] += 1
+            if error:
+                self.counters['rejected'] += 1
+        if error:
+            self.reply(host, inverter, dict(inv=inverter, id=request_id, error=error))
+            return
+        (found, missing) = self.cache.get(host, inverter, values)
+        if not missing:
+            with self.__lock:
+                self.counters['from_cache'] += 1
+            self.reply(host, inverter, dict(inv=inverter, id=request_id, source='cache', latency=0.0,
+                                      values={k: jsonable(v) for (k, v) in found.items()}))
+            return
+        with self.__lock:
+            demand = self.__pending.get((host, inverter))
+            if demand is None:
+                demand = self.__pending[(host, inverter)] = Demand(host, inverter)
+            else:
+                self.counters['coalesced'] += 1
+            demand.values.update(dict.fromkeys(missing))
+            demand.waiters.append((values, request_id, time.monotonic()))
+        self.wakeup.set()
+
+    def take(self, limit=None):
+        '''Demandes à servir (boucle d'interrogation), au plus limit onduleurs'''
+        with self.__lock:
+            demands = []
+            while self.__pending and (limit is None or len(demands) < limit):
+                demands.append(self.__pending.popitem(last=False)[1])
+        return demands
+
+    def missing(self, demand):
+        '''Registres de la demande toujours absents du cache (l'interrogation a pu les lire entre-temps)'''
+        return self.cache.get(demand.host, demand.inverter, list(demand.values), count=False)[1]
+
+    def complete(self, demand, sample):
+        '''
+            sample: Sample lu pour les registres manquants (vide si le cache
+            suffisait finalement), None si l'onduleur n'a pas répondu
+        '''
+        now = time.monotonic()
+        with self.__lock:
+            if sample is None:
+                self.counters['failures'] += 1
+            elif sample:
+                self.counters['frames'] += 1
+        if sample is None:
+            logger.info(f'{demand!r}: pas de réponse')
+        elif sample:
+            self.cache.update(demand.host, demand.inverter, sample, now)
+        for (values, request_id, since) in demand.waiters:
+            (found, missing) = self.cache.get(demand.host, demand.inverter, values, now, count=False)
+            payload = dict(inv=demand.inverter, id=request_id, source='bus', latency=round(now - since, 4),
+                           values={k: jsonable(v) for (k, v) in found.items()})
+            if missing:
+                payload['error'] = f'pas de réponse pour {missing}'
+            self.reply(demand.host, demand.inverter, payload)
+
+    def pending(self):
+        return len(self.__pending)
+
+    def stats(self):
+        return dict(self.counters, pending=self.pending(), cache=self.cache.stats())
+
+
+def coerce(key, value):
+    '''Valeur d'un /set (json) vers le type du registre; ValueError si impossible'''
+    register = registers[key]
+    if register.type is datetime.datetime:
+        value = datetime.datetime.fromisoformat(value) if isinstance(value, str) else value
+    elif register.type is tuple:
+        value = tuple(int(v) for v in value)
+    else:
+        value = register.type(value)
+    register.encode(value)
+    return value
+
+
+class OnDemandWriter(object):
+
+    def __init__(self, cache, reply, interval=2.0, writable=None, max_registers=16, wakeup=None):
+        '''
+            reply(host, inverter, payload): publication du résultat
+            interval: secondes minimum entre deux trames d'écriture vers un onduleur
+            writable: registres autorisés (aucun par défaut: /set refusé)
+        '''
+        self.cache = cache
+        self.reply = reply
+        self.interval = interval
+        self.writable = frozenset(k.upper() for k in writable or ())
+        unknown = sorted(self.writable.difference(registers))
+        if unknown:
+            raise ValueError(f'ondemand.writable: registres inconnus {unknown}')
+        self.max_registers = max_registers
+        self.wakeup = wakeup or threading.Event()
+        self.latency = Histogram()
+        self.__lock = threading.Lock()
+        self.__pending = OrderedDict()      # (hôte, onduleur) -> Demand
+        self.__last = {}                    # (hôte, onduleur) -> date de la dernière trame
+        self.counters = dict(requests=0, coalesced=0, frames=0, confirmed=0, failures=0, rejected=0)
+
+    def __repr__(self):
+        return 'OnDemandWriter[%i pending / every %ss / %s]' % (len(self.__pending), self.interval, self.counters)
+
+    def request(self, host, inverter, settings, request_id=None):
+        '''Appelée depuis le thread mqtt; settings: {registre: valeur}'''
+        error = None
+        try:
+            if not self.writable:
+                logger.error(f'/set WR {inverter} sur {host} refusé: aucun registre modifiable (ondemand.writable)')
+                raise ValueError('aucun registre modifiable')
+            if not isinstance(settings, dict) or not settings or len(settings) > self.max_registers:
+                raise ValueError(f'de 1 à {self.max_registers} registres')
+            values = {}
+            for (key, value) in settings.items():
+                key = key.upper()
+                if key not in self.writable:
+                    raise ValueError(f'registre non modifiable: {key}')
+                values[key] = coerce(key, value)
+        except (ValueError, TypeError) as e:
+            error = str(e)
+        with self.__lock:
+            # compteurs partagés avec la boucle d'interrogation (complete)
+            self.counters['requests'] += 1
+            if error:
+                self.counters['rejected'] += 1
+        if error:
+            self.reply(host, inverter, dict(inv=inverter, id=request_id, error=error))
+            return
+        with self.__lock:
+            demand = self.__pending.get((host, inverter))
+            if demand is None:
+                demand = self.__pending[(host, inverter)] = Demand(host, inverter)
+            else:
+                self.counters['coalesced'] += 1
+            demand.values.update(values)
+            demand.waiters.append((list(values), request_id, time.monotonic()))
+        self.wakeup.set()
+
+    def delay(self, now=None):
+        '''None: rien en attente, 0: une écriture est permise, sinon secondes avant la prochaine'''
+        now = now or time.monotonic()
+        with self.__lock:
+            if not self.__pending:
+                return None
+            return max(min(self.__last.get(i, 0.0) + self.interval - now for i in self.__pending), 0.0)
+
+    def take(self, limit=None, now=None):
+        '''Écritures dont l'onduleur a passé son délai, au plus limit'''
+        now = now or time.monotonic()
+        with self.__lock:
+            due = [i for i in self.__pending if now - self.__last.get(i, 0.0) >= self.interval][:limit]
+            for key in due:
+                self.__last[key] = now
+            return [self.__pending.pop(key) for key in due]
+
+    def complete(self, demand, sample, elapsed):
+        '''sample: valeurs renvoyées par l'onduleur, None sans réponse; elapsed: aller-retour de la trame'''
+        now = time.monotonic()
+        confirmed = {k: v for (k, v) in sample.items() if k in demand.values} if sample else {}
+        # état inconnu sans confirmation: la prochaine lecture ira aussi sur le bus
+        self.cache.invalidate(demand.host, demand.inverter, list(demand.values))
+        with self.__lock:
+            if sample is None:
+                self.counters['failures'] += 1
+            else:
+                self.counters['frames'] += 1
+                self.counters['confirmed'] += len(confirmed)
+        if sample is None:
+            logger.info(f'{demand!r}: pas de réponse')
+        else:
+            self.latency.observe(elapsed)
+        for (keys, request_id, since) in demand.waiters:
+            payload = dict(inv=demand.inverter, id=request_id, latency=round(elapsed, 4), queued=round(now - since - elapsed, 4),
+                           written={k: jsonable(confirmed[k]) for k in keys if k in confirmed})
+            missing = [k for k in keys if k not in confirmed]
+            if missing:
+                payload['error'] = f'non confirmé: {missing}'
+            self.reply(demand.host, demand.inverter, payload)
+
+    def pending(self):
+        return len(self.__pending)
+
+    def stats(self):
+        return dict(self.counters, pending=self.pending(), latency=self.latency.snapshot())
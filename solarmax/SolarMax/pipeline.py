@@ -0,0 +1,139 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Requêtes en pipeline sur une connexion partagée
+
+Une passerelle RS485/TCP dessert plusieurs onduleurs derrière une seule
+adresse IP. Au lieu d'attendre chaque réponse avant d'envoyer la requête
+suivante, PipelineScheduler envoie jusqu'à 'window' trames d'avance et
+associe les réponses aux requêtes grâce à l'adresse de l'en-tête
+'{NN;FB;..'. Chaque requête a son propre délai et ses relances.
+'''
+import socket, time, logging
+from collections import deque
+from .instrumentation import classify
+
+logger = logging.getLogger(__name__)
+
+
+class Request(object):
+    __slots__ = ('idn', 'frame', 'retries', 'deadline', 'sent')
+
+    def __init__(self, idn, frame, retries):
+        self.idn = int(idn)
+        self.frame = frame
+        self.retries = retries
+        self.deadline = 0
+        self.sent = 0
+
+    def __repr__(self):
+        return 'Request[WR %i / retries=%i]' % (self.idn, self.retries)
+
+
+class PipelineScheduler(object):
+
+    def __init__(self, parse, timeout=10, retries=1, window=8, instruments=None):
+        self.parse = parse
+        self.instruments = instruments
+        self.timeout = timeout
+        self.retries = retries
+        self.window = window
+        self.stats = dict(requests=0, replies=0, timeouts=0, retries=0, errors=0, stale=0, elapsed=0.0, rps=0.0)
+
+    def __repr__(self):
+        return 'PipelineScheduler[window=%i / %s]' % (self.window, self.stats)
+
+    def __expire(self, inflight, pending, now):
+        for idn in [i for (i, r) in inflight.items() if r.deadline <= now]:
+            request = inflight.pop(idn)
+            self.stats['timeouts'] += 1
+            if self.instruments:
+                self.instruments.error('timeout')
+            self.__retry(request, pending)
+
+    def __retry(self, request, pending):
+        if request.retries > 0:
+            request.retries -= 1
+            self.stats['retries'] += 1
+            pending.appendleft(request)
+        else:
+            logger.debug('WR %i: no answer' % request.idn)
+
+    def run(self, sock, reader, requests, keys=None):
+        '''
+            requests: [(inverter, trame bytes), ...]
+            keys: registres demandés; une réponse qui en contient d'autres
+            est la réponse tardive d'une requête précédente.
+            Retourne {inverter: (inverter, data brut) ou None}.
+            Une erreur socket autre qu'un délai dépassé est propagée.
+        '''
+        pending = deque(Request(idn, frame, self.retries) for (idn, frame) in requests)
+        results = {r.idn: None for r in pending}
+        inflight = {}
+        started = time.monotonic()
+        previous_timeout = sock.gettimeout()
+        self.stats['requests'] += len(pending)
+        try:
+            while pending or inflight:
+                now = time.monotonic()
+                burst = []
+                for request in list(pending):
+                    if len(inflight) >= self.window:
+                        break
+                    # une seule requête en vol par adresse: c'est la clé de correspondance
+                    if request.idn in inflight:
+                        continue
+                    pending.remove(request)
+                    request.sent = now
+                    request.deadline = now + self.timeout
+                    inflight[request.idn] = request
+                    burst.append(request.frame)
+                if burst:
+                    logger.debug('pipeline => %i frames' % len(burst))
+                    sock.sendall(b''.join(burst))
+
+                sock.settimeout(max(min(r.deadline for r in inflight.values()) - now, 0.001))
+                try:
+                    answer = reader.read_frame()
+                except socket.timeout:
+                    self.__expire(inflight, pending, time.monotonic())
+                    continue
+                if not answer:
+                    if self.instruments:
+                        self.instruments.error('empty_read')
+                    raise ConnectionError('connection closed by peer')
+
+                try:
+                    (inverter, data) = self.parse(answer)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    if self.instruments:
+                        self.instruments.error(classify(e))
+                    logger.debug('pipeline: bad answer %s (%s)' % (answer, e))
+                    # l'adresse reste souvent lisible malgré une erreur de somme ou de longueur
+                    request = inflight.pop(int(answer[1:3]), None) if answer[1:3].isdigit() else None
+                    if request:
+                        self.__retry(request, pending)
+                    continue
+
+                request = inflight.get(inverter)
+                if request is not None and keys and not keys.issuperset(data):
+                    request = None
+                else:
+                    inflight.pop(inverter, None)
+                if request is None:
+                    # réponse tardive à une requête déjà expirée
+                    self.stats['stale'] += 1
+                    if self.instruments:
+                        self.instruments.error('stale')
+                    continue
+                self.stats['replies'] += 1
+                if self.instruments:
+                    self.instruments.observe(inverter, time.monotonic() - request.sent)
+                results[inverter] = (inverter, data)
+        finally:
+            sock.settimeout(previous_timeout)
+            self.stats['elapsed'] += time.monotonic() - started
+            if self.stats['elapsed'] > 0:
+                self.stats['rps'] = self.stats['replies'] / self.stats['elapsed']
+        return results
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Cache des registres lus, par onduleur
+
+Un onduleur est identifié par son hôte et son numéro, car chaque
+passerelle à un seul onduleur a son onduleur numéro 1. Chaque registre a
+sa durée de validité: l'identité de l'onduleur (TYP, PIN, FDAT, SWV...)
+ne change pas, PAC change à chaque seconde. Une requête ne demande au
+bus que les registres absents ou périmés et complète la réponse avec les
+valeurs en cache (merge). Le cache est partagé entre la boucle
+d'interrogation et le thread mqtt (/get): un verrou protège ses tables.
+'''
+import time, threading
+from .codec import sample_type
+
+# registres fixes: type, puissance installée, mise en service, versions
+REGISTER_TTLS = dict.fromkeys(('ADR', 'TYP', 'PIN', 'FDAT', 'SWV', 'BDN', 'MAC', 'DIN'), 86400)
+
+
+def merge(values, found, sample=None):
+    '''Sample des registres 'values', depuis le cache (found) et la réponse lue (sample)'''
+    data = dict(found)
+    if sample:
+        data.update(sample.items())
+    keys = [k for k in values if k in data]
+    (cls, _) = sample_type(keys)
+    return cls._make([data[k] for k in keys])
+
+
+class RegisterCache(object):
+    '''Dernière valeur lue de chaque registre, par (hôte, onduleur), valable ttl secondes (ou ttls[registre])'''
+
+    def __init__(self, ttl=5.0, ttls=None):
+        self.ttl = ttl
+        self.ttls = dict(REGISTER_TTLS, **(ttls or {}))
+        self.__values = {}          # (hôte, onduleur) -> {registre: (valeur, date)}
+        self.__registers = {}       # registre -> [hits, misses]
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'RegisterCache[ttl=%ss / %i inverters / hits=%i / misses=%i]' % (self.ttl, len(self.__values), self.hits, self.misses)
+
+    def update(self, host, inverter, sample, now=None):
+        now = now or time.monotonic()
+        with self.__lock:
+            values = self.__values.setdefault((host, int(inverter)), {})
+            for (key, value) in sample.items():
+                values[key] = (value, now)
+
+    def get(self, host, inverter, keys, now=None, count=True):
+        '''({registre: valeur} encore valables, [registres à lire])'''
+        now = now or time.monotonic()
+        (found, missing) = ({}, [])
+        with self.__lock:
+            values = self.__values.get((host, int(inverter)), {})
+            for key in keys:
+                entry = values.get(key)
+                hit = entry is not None and now - entry[1] < self.ttls.get(key, self.ttl)
+                if hit:
+                    found[key] = entry[0]
+                else:
+                    missing.append(key)
+                if count:
+                    counter = self.__registers.get(key)
+                    if counter is None:
+                        counter = self.__registers[key] = [0, 0]
+                    counter[0 if hit else 1] += 1
+            if count:
+                self.hits += len(found)
+                self.misses += len(missing)
+        return found, missing
+
+    def invalidate(self, host=None, inverter=None, keys=None):
+        '''Oublie tout, un hôte, un onduleur ou certains de ses registres'''
+        with self.__lock:
+            if host is None:
+                self.__values.clear()
+            elif inverter is None:
+                for key in [k for k in self.__values if k[0] == host]:
+                    del self.__values[key]
+            elif keys is None:
+                self.__values.pop((host, int(inverter)), None)
+            else:
+                values = self.__values.get((host, int(inverter)), {})
+                for key in keys:
+                    values.pop(key, None)
+
+    def stats(self):
+        with self.__lock:
+            (hits, misses) = (self.hits, self.misses)
+            registers = {k: round(h / (h + m), 3) for (k, (h, m)) in sorted(self.__registers.items())}
+        total = hits + misses
+        return dict(hits=hits, misses=misses, hit_ratio=round(hits / total, 3) if total else 0.0, registers=registers)
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Ordonnancement des registres à interroger
+
+Chaque groupe de registres a sa période: PAC/IDC/UDC souvent, KDY/KT0
+rarement, FDAT une fois par jour. Un cycle ne demande à un onduleur que
+les registres dont la période est échue; les dernières valeurs lues des
+autres complètent l'échantillon publié. Quand le status indique un
+rayonnement trop faible ou l'absence de communication (ou que l'onduleur
+ne répond pas), toutes les périodes sont multipliées par night_factor,
+puis reviennent à la normale dès que la production reprend.
+'''
+import time, logging
+from .codec import sample_type
+
+logger = logging.getLogger(__name__)
+
+# 'Pas de communication', 'Trop peu de rayonnement'
+IDLE_CODES = frozenset([20000, 20002])
+
+
+class InverterSchedule(object):
+    __slots__ = ('next_due', 'pending', 'idle', 'values')
+
+    def __init__(self, groups):
+        self.next_due = [0.0] * groups
+        self.pending = ()
+        self.idle = False
+        self.values = {}
+
+    def __repr__(self):
+        return 'InverterSchedule[idle=%s / %i values]' % (self.idle, len(self.values))
+
+
+class RegisterScheduler(object):
+
+    def __init__(self, groups, night_factor=12, idle_codes=IDLE_CODES):
+        '''groups: [(période en secondes, [registres]), ...]'''
+        self.groups = [(period, tuple(values)) for (period, values) in groups]
+        self.night_factor = night_factor
+        self.idle_codes = idle_codes
+        self.all_values = tuple(dict.fromkeys(v for (_, values) in self.groups for v in values))
+        self.__inverters = {}
+        self.counters = dict(polls=0, skipped=0, registers=0, registers_saved=0, failures=0)
+
+    def __repr__(self):
+        return 'RegisterScheduler[%i groups / night x%s / %s]' % (len(self.groups), self.night_factor, self.counters)
+
+    @classmethod
+    def from_config(cls, conf, default_values):
+        # sans configuration: tous les registres à chaque cycle, comme avant
+        if not conf:
+            return cls([(0, default_values)], night_factor=1)
+        groups = [(g['period'], list(g['values'])) for g in conf['groups']]
+        if not groups:
+            raise ValueError('solarmax.schedule: aucun groupe de registres')
+        # l'échantillon publié a besoin de tous les registres par défaut: les oubliés
+        # rejoignent le groupe le plus fréquent
+        configured = set(v for (_, values) in groups for v in values)
+        missing = [v for v in default_values if v not in configured]
+        if missing:
+            logger.warning(f'solarmax.schedule: registres {missing} absents des groupes, lus avec le groupe le plus fréquent')
+            min(groups, key=lambda g: g[0])[1].extend(missing)
+        return cls(groups, conf.get('night_factor', 12))
+
+    def add_group(self, period, values):
+        '''Groupe supplémentaire (historique des alarmes...), avant la première interrogation'''
+        self.groups.append((period, tuple(values)))
+        self.all_values = tuple(dict.fromkeys(v for (_, values) in self.groups for v in values))
+
+    def __schedule(self, key):
+        schedule = self.__inverters.get(key)
+        if schedule is None:
+            schedule = self.__inverters[key] = InverterSchedule(len(self.groups))
+        return schedule
+
+    def due(self, key, now=None):
+        '''Registres à demander maintenant à cet onduleur ([] si rien n'est échu)'''
+        now = now or time.monotonic()
+        schedule = self.__schedule(key)
+        schedule.pending = tuple(n for (n, next_due) in enumerate(schedule.next_due) if next_due <= now)
+        if not schedule.pending:
+            self.counters['skipped'] += 1
+            return []
+        values = list(dict.fromkeys(v for n in schedule.pending for v in self.groups[n][1]))
+        self.counters['polls'] += 1
+        self.counters['registers'] += len(values)
+        self.counters['registers_saved'] += len(self.all_values) - len(values)
+        return values
+
+    def __reschedule(self, schedule, now):
+        factor = self.night_factor if schedule.idle else 1
+        for n in schedule.pending:
+            schedule.next_due[n] = now + self.groups[n][0] * factor
+        schedule.pending = ()
+
+    def update(self, key, sample, now=None):
+        '''Intègre un échantillon lu et retourne l'échantillon complet (Sample)'''
+        now = now or time.monotonic()
+        schedule = self.__schedule(key)
+        schedule.values.update(sample.items())
+        if 'SYS' in sample:
+            self.__set_idle(schedule, sample['SYS'][0] in self.idle_codes, now)
+        self.__reschedule(schedule, now)
+        return self.sample(key)
+
+    def __set_idle(self, schedule, idle, now):
+        if idle == schedule.idle:
+            return
+        schedule.idle = idle
+        if idle:
+            # la nuit tombe: tous les groupes ralentissent
+            schedule.next_due = [max(d, now + p * self.night_factor) for (d, (p, _)) in zip(schedule.next_due, self.groups)]
+        else:
+            # la production reprend: tous les groupes retrouvent leur cadence
+            schedule.next_due = [min(d, now + p) for (d, (p, _)) in zip(schedule.next_due, self.groups)]
+
+    def failure(self, key, now=None):
+        now = now or time.monotonic()
+        schedule = self.__schedule(key)
+        self.counters['failures'] += 1
+        self.__set_idle(schedule, True, now)
+        self.__reschedule(schedule, now)
+
+    def idle(self, key):
+        return self.__schedule(key).idle
+
+    def sample(self, key):
+        values = self.__schedule(key).values
+        (cls, _) = sample_type(values.keys())
+        return cls._make(values.values())
+
+    def stats(self):
+        return dict(self.counters, idle=sum(1 for s in self.__inverters.values() if s.idle))
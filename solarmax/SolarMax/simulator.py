@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Simulateur d'onduleurs SolarMax (serveur TCP asyncio)
+
+Sert le même tramage {NN;FB;LL|64:...|CSUM} que les onduleurs réels:
+identifiants, TYP/PIN configurables, courbes PAC/KDY réalistes sur la
+journée, latence de réponse, écritures TCP fragmentées et injection
+d'erreurs de somme de contrôle ou de longueur.
+
+Plusieurs centaines d'onduleurs tiennent dans un seul processus:
+
+    cd solarmax
+    python -m SolarMax.simulator --hosts 100 --inverters 1,2,3 --latency 0.05
+
+Les hôtes simulés écoutent sur 127.0.0.1, 127.0.0.2, ... port 12345,
+comme le démon s'y attend. Depuis un test ou un benchmark:
+
+    sim = SimulatorThread([InverterSimulator('127.0.0.1', 12345, [SimulatedInverter(1)])])
+    sim.start()
+    ...
+    sim.stop()
+'''
+import asyncio, threading, argparse, ipaddress, logging, math, random, time, datetime
+from .solarmax_fr import checksum, build_answer, query_set
+from .codec import registers, encode_value
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class SimulatedInverter(object):
+
+    def __init__(self, idn, typ=20010, pin=1980, kt0=8000, fdat=datetime.datetime(2011, 10, 31, 12, 0), hour=None, seed=None):
+        self.idn = idn
+        self.typ = typ
+        self.pin = pin
+        self.kt0 = kt0
+        self.fdat = fdat
+        self.hour = hour                # heure fixe (tests), sinon l'heure locale
+        self.random = random.Random(seed if seed is not None else idn)
+        self.kdy = 0.0
+        self.sal = 0
+        self.errors = []                # historique EC00..EC08, la plus récente d'abord
+        self.settings = {}
+        self.__day = None
+        self.__last = None
+
+    def __repr__(self):
+        return 'SimulatedInverter[WR %i / TYP=%i / PIN=%i]' % (self.idn, self.typ, self.pin)
+
+    def alarm(self, code, when=None):
+        '''Ajoute une erreur à l'historique (tests de l'historique des alarmes)'''
+        when = when or datetime.datetime.now()
+        date = (when.year << 16) | (when.month << 8) | when.day
+        self.errors = [(date, when.hour * 3600 + when.minute * 60 + when.second, code, 0)] + self.errors[:8]
+
+    def hour_of_day(self, now):
+        if self.hour is not None:
+            return self.hour
+        t = time.localtime(now)
+        return t.tm_hour + t.tm_min / 60 + t.tm_sec / 3600
+
+    def pac(self, now):
+        # cloche entre 6h et 20h, légèrement bruitée par les nuages
+        h = self.hour_of_day(now)
+        if not 6 < h < 20:
+            return 0.0
+        sun = math.sin(math.pi * (h - 6) / 14) ** 1.5
+        return round(self.pin * sun * (0.85 + 0.15 * self.random.random()), 1)
+
+    def values(self, now=None):
+        now = now or time.time()
+        day = time.localtime(now).tm_yday
+        if day != self.__day:
+            self.__day, self.kdy = day, 0.0
+        pac = self.pac(now)
+        if self.__last is not None:
+            self.kdy += pac * max(now - self.__last, 0) / 3600000
+        self.__last = now
+
+        pdc = pac / 0.95
+        udc = 340.0 + 30 * self.random.random() if pac else 0.0
+        ul1 = 230.0 + 2 * self.random.random()
+        return {
+            'ADR': self.idn, 'TYP': self.typ, 'PIN': self.pin,
+            'PAC': pac, 'PRL': int(100 * pac / self.pin),
+            'UDC': udc, 'IDC': pdc / udc if udc else 0.0,
+            'UL1': ul1, 'IL1': pac / ul1, 'TNF': 50.0,
+            'TKK': int(20 + 30 * pac / self.pin),
+            'KDY': self.kdy, 'KMT': int(self.kdy), 'KYR': int(self.kdy), 'KT0': int(self.kt0 + self.kdy),
+            'KHR': 20000, 'CAC': 1500,
+            'SYS': (20004 if pac else 20002, 0), 'SAL': self.sal,
+            'FDAT': self.fdat, 'SDAT': datetime.datetime.fromtimestamp(int(now)),
+            'MAC': 0, 'BDN': 0, 'SWV': 0, 'DIN': 0, 'LAN': 0,
+        }
+
+    def answer(self, keys, now=None):
+        values = self.values(now)
+        data = []
+        for key in keys:
+            if key.startswith('EC'):
+                n = int(key[2:])
+                value = encode_value(key, self.errors[n]) if n < len(self.errors) else '0'
+            elif key in self.settings:
+                value = self.settings[key]
+            else:
+                value = encode_value(key, values[key])
+            data.append((key, value))
+        return data
+
+
+class InverterSimulator(object):
+    '''Un hôte TCP (onduleur ou passerelle RS485) et ses onduleurs'''
+
+    def __init__(self, host, port, inverters, latency=0.0, fragment=0, checksum_errors=0.0, length_errors=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.inverters = {inv.idn: inv for inv in inverters}
+        self.latency = latency
+        self.fragment = fragment
+        self.checksum_errors = checksum_errors
+        self.length_errors = length_errors
+        self.random = random.Random(seed)
+        self.server = None
+        self.__clients = set()
+        self.stats = dict(connections=0, queries=0, answers=0, unknown=0, bad_queries=0, injected_errors=0)
+
+    def __repr__(self):
+        return 'InverterSimulator[%s:%s / %s]' % (self.host, self.port, sorted(self.inverters))
+
+    def parse_query(self, query):
+        # {FB;NN;LL|64:KEY;KEY|CSUM}
+        query = query.strip()
+        if query[:1] != '{' or query[-1:] != '}':
+            raise ValueError('malformed query')
+        (content, csum) = (query[1:-5], query[-5:-1])
+        if checksum(content) != csum:
+            raise ValueError('checksum error')
+        (header, body, _) = content.split('|', 2)
+        (fb, idn, _) = header.split(';', 2)
+        if fb != 'FB':
+            raise ValueError('query not understood')
+        (qtype, body) = body.split(':', 1)
+        return (int(idn), int(qtype, 16), body.split(';'))
+
+    def answer(self, query):
+        (idn, qtype, items) = self.parse_query(query)
+        inverter = self.inverters.get(idn)
+        if inverter is None:
+            # adresse absente du bus: pas de réponse, comme un onduleur éteint
+            self.stats['unknown'] += 1
+            return None
+
+        if qtype == 200:
+            data = []
+            for item in items:
+                (key, value) = item.split('=')
+                inverter.settings[key] = value
+                data.append((key, value))
+        else:
+            keys = [k for k in items if k in query_set and k in registers]
+            data = inverter.answer(keys)
+
+        answer = build_answer(idn, data, qtype)
+        if self.checksum_errors and self.random.random() < self.checksum_errors:
+            self.stats['injected_errors'] += 1
+            answer = answer[:-2] + ('0' if answer[-2] != '0' else '1') + '}'
+        elif self.length_errors and self.random.random() < self.length_errors:
+            self.stats['injected_errors'] += 1
+            # longueur fausse mais somme de contrôle recalculée
+            body = answer[1:7] + '%02X' % ((int(answer[7:9], 16) + 1) & 0xFF) + answer[9:-5]
+            answer = '{%s%s}' % (body, checksum(body))
+        return answer
+
+    async def write(self, writer, data):
+        if self.fragment:
+            for i in range(0, len(data), self.fragment):
+                writer.write(data[i:i+self.fragment])
+                await writer.drain()
+                await asyncio.sleep(0)
+        else:
+            writer.write(data)
+            await writer.drain()
+
+    async def handle(self, reader, writer):
+        self.stats['connections'] += 1
+        self.__clients.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    query = await reader.readuntil(b'}')
+                except asyncio.IncompleteReadError:
+                    break
+                self.stats['queries'] += 1
+                try:
+                    answer = self.answer(query.decode('ascii', 'replace'))
+                except Exception as e:
+                    self.stats['bad_queries'] += 1
+                    logger.debug(f'{self!r}: bad query {query!r} ({e})')
+                    continue
+                if answer is None:
+                    continue
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                await self.write(writer, answer.encode())
+                self.stats['answers'] += 1
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.__clients.discard(asyncio.current_task())
+            writer.close()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, reuse_address=True)
+        return self
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            clients = list(self.__clients)
+            for task in clients:
+                task.cancel()
+            await asyncio.gather(*clients, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+
+class SimulatorThread(object):
+    '''Fait tourner des InverterSimulator dans une boucle asyncio dédiée'''
+
+    def __init__(self, simulators):
+        self.simulators = simulators
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    async def __start(self):
+        await asyncio.gather(*(s.start() for s in self.simulators))
+
+    async def __stop(self):
+        await asyncio.gather(*(s.stop() for s in self.simulators))
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.__start(), self.loop).result()
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.__stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def make_plant(hosts=1, inverters=(1,), host='127.0.0.1', port=12345, typ=20010, pin=1980, hour=None, **options):
+    '''hosts simulateurs sur des adresses de bouclage consécutives'''
+    first = ipaddress.ip_address(host)
+    return [
+        InverterSimulator(str(first + n), port, [SimulatedInverter(idn, typ, pin, hour=hour, seed=n * 1000 + idn) for idn in inverters], **options)
+        for n in range(hosts)
+    ]
+
+
+def inverters_config(simulators):
+    '''Dictionnaire 'inverters' de la configuration du démon pour ces simulateurs'''
+    return {s.host: sorted(s.inverters) for s in simulators}
+
+
+async def serve(simulators):
+    await asyncio.gather(*(s.start() for s in simulators))
+    count = sum(len(s.inverters) for s in simulators)
+    logger.info(f'{len(simulators)} hôtes, {count} onduleurs simulés')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await asyncio.gather(*(s.stop() for s in simulators))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulateur d'onduleurs SolarMax")
+    parser.add_argument("--host", default='127.0.0.1', help="Première adresse d'écoute")
+    parser.add_argument("--port", type=int, default=12345, help="Port TCP")
+    parser.add_argument("--hosts", type=int, default=1, help="Nombre d'hôtes (adresses consécutives)")
+    parser.add_argument("--inverters", default='1', help="Identifiants par hôte, ex: 1,2,3")
+    parser.add_argument("--typ", type=int, default=20010, choices=[20010, 20020, 20030, 20040], help="TYP des onduleurs")
+    parser.add_argument("--pin", type=int, default=1980, help="Puissance installée (W)")
+    parser.add_argument("--hour", type=float, default=None, help="Heure simulée fixe (sinon heure locale)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latence de réponse (s)")
+    parser.add_argument("--fragment", type=int, default=0, help="Taille des écritures TCP fragmentées (octets)")
+    parser.add_argument("--checksum-errors", type=float, default=0.0, help="Taux d'erreurs de somme de contrôle")
+    parser.add_argument("--length-errors", type=float, default=0.0, help="Taux d'erreurs de longueur")
+    args = parser.parse_args()
+    simulators = make_plant(
+        args.hosts, [int(i) for i in args.inverters.split(',')], args.host, args.port, args.typ, args.pin, args.hour,
+        latency=args.latency, fragment=args.fragment, checksum_errors=args.checksum_errors, length_errors=args.length_errors,
+    )
+    try:
+        asyncio.run(serve(simulators))
+    except KeyboardInterrupt:
+        pass
@@ -19,6 +19,7 @@
 
 
 import socket, datetime
+from .framing import FrameReader
 
 
 # Konstanten
@@ -92,6 +93,7 @@ class SolarMax ( object ):
     self.__port = port
     self.__inverters = {}
     self.__socket = None
+    self.__reader = None
     self.__connected = False
     self.__allinverters = False
     self.__inverter_list = []
@@ -115,6 +117,7 @@ class SolarMax ( object ):
       self.__connected = False
       self.__allinverters = False
       self.__socket = None
+      self.__reader = None
 
   def __del__(self):
     DEBUG('destructor called')
@@ -130,6 +133,7 @@ class SolarMax ( object ):
       s.settimeout(2)
       s.connect((self.__host, self.__port))
       s.settimeout(10)
+      self.__reader = FrameReader(s)
       self.__connected = True
       DEBUG('connected.')
     except:
@@ -159,15 +163,7 @@ class SolarMax ( object ):
 
   def __receive(self):
     try:
-      data = ''
-      tmp = ''
-      while True:
-         tmp = self.__socket.recv(1)
-         data += tmp
-         if len(tmp) < 1 or tmp == '}':
-           break
-         tmp = ''
-      return data
+      return self.__reader.read_frame()
     except:
       self.__allinverters = False
       return ""
@@ -18,7 +18,13 @@
 # Released to the public in 2012.
 
 
-import socket, datetime, logging
+import socket, datetime, time, logging
+from collections import OrderedDict
+from .codec import normalize_value, encode_value, decode, registers
+from .pipeline import PipelineScheduler
+from .connection import Connection, InverterHealth
+from .instrumentation import Instruments, classify
+from .regcache import merge
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -40,6 +46,8 @@ query_types = [
         'BDN', 'SWV', 'DIN', 'LAN', 'SDAT', 'FDAT'
     ]
 
+query_set = frozenset(query_types)
+
 status_codes = {
     20000: 'Pas de communication',
     20001: 'En cours d\'utilisation',
@@ -73,6 +81,13 @@ alarm_codes = {
     65536: "Alarme 17",
   }
 
+# masque SAL -> descriptions, une table de 256 entrées par octet du masque:
+# trois lectures de table au lieu d'un test par code d'alarme
+ALARM_TABLES = tuple(
+    tuple(tuple(alarm_codes[1 << (8 * n + b)] for b in range(8) if byte & (1 << b) and (1 << (8 * n + b)) in alarm_codes) for byte in range(256))
+    for n in range(3)
+)
+
 # Hilfs-Routine (DEBUG)
 
 def DEBUG(*s):
@@ -86,296 +101,531 @@ def get_status_code(v):
             return i
     return None
 
+####################################
+## protocole
+####################################
+
+def hexval(i):
+    return (hex(i)[2:]).upper()
+
+
+def checksum(s):
+    return '%04X' % sum(map(ord, s))
+
+
+def parse_answer(answer):
+    # convenience checks
+    if answer[0] != '{' or answer[-1] != '}':
+        raise ValueError('malformed answer: %s' % answer)
+    raw_answer = answer
+    answer = answer[1:-1]
+    csum = answer[-4:]
+    content = answer[:-4]
+    # checksum
+    if csum != checksum(content):
+        raise ValueError('checksum error')
+
+    (header, content) = content[:-1].split('|', 2)
+    (inverter, fb, length) = header.split(';', 3)
+    if fb != 'FB':
+        raise ValueError('answer not understood')
+    # length
+    length = int(length, 16)
+    if length != len(raw_answer):
+        raise ValueError('length mismatch')
+
+    inverter = int(inverter)
+
+    # Bei schreibzugriff antwortet der WR mit 'C8'
+    # Avec un accès en écriture, le WR répond par 'C8'
+    #if not content.startswith('64:'):
+    #  raise ValueError('Inverter did not understand our query')
+
+    content = content[3:]
+    data = {}
+
+    for item in content.split(';'):
+        (key, value) = item.split('=')
+        if key not in query_set:
+            raise NotImplementedError("Don't know %s" % item)
+        data[key] = value
+    return (inverter, data)
+
+
+def answer_keys(answer):
+    '''Registres d'une réponse brute, sans la décoder ('{01;FB;2D|64:KDY=82;PAC=F6|0A6B}')'''
+    parts = answer.split('|')
+    if len(parts) < 3:
+        return ()
+    return tuple(item.partition('=')[0] for item in parts[1][3:].split(';'))
+
+
+# champ longueur des trames sur deux chiffres hexa
+MAX_FRAME_LENGTH = 0xFF
+# {, adresse (2), ;FB; (4), longueur (2), |64: (4), | (1), somme (4), }, moins le ; absent après la dernière valeur
+ANSWER_OVERHEAD = 1 + 2 + 4 + 2 + 4 + 1 + 4 + 1 - 1
+
+
+def split_values(values):
+    '''
+        Registres d'une lecture, découpés en requêtes dont la réponse tient
+        dans une trame (MAX_FRAME_LENGTH) quelles que soient les valeurs.
+    '''
+    chunks = [[]]
+    length = ANSWER_OVERHEAD
+    for key in values:
+        # 'KEY=valeur;'
+        size = len(key) + 1 + (registers[key].width if key in registers else 8) + 1
+        if chunks[-1] and length + size > MAX_FRAME_LENGTH:
+            chunks.append([])
+            length = ANSWER_OVERHEAD
+        chunks[-1].append(key)
+        length += size
+    return chunks
+
+
+def build_query(idn, values, qtype=100):
+    qtype = hexval(qtype)
+    if type(values) == list:
+        for v in values:
+            if v not in query_set:
+                raise ValueError('Unknown data type »'+v+'«')
+        values = ';'.join(values)
+
+    #elif type(values) in [str, unicode]:
+    elif type(values) in [str,]:
+        pass
+    else:
+        raise ValueError('value has unsupported type')
+
+    querystring = '|' + qtype + ':' + values + '|'
+    # Länge vergrößern um: 2 x { (2), WR-Nummer (2), "FB" (2), zwei Semikolon (2), Länge selbst (2), checksumme (4)
+    # Augmentez la longueur de : 2 x { (2), le numéro WR (2), "FB" (2), deux points-virgules (2), la longueur elle-même (2), la somme de contrôle (4)
+    l = len(querystring) + 2 + 2 + 2 + 2 +2 + 4
+    querystring = 'FB;%02i;%s%s' % (int(idn), hexval(l), querystring)
+    querystring += checksum(querystring)
+    return '{%s}' % querystring
+
+
+def build_answer(idn, data, qtype=100):
+    '''
+        Trame de réponse d'un onduleur (utilisée par le simulateur):
+        data: [(registre, valeur hexa), ...]
+    '''
+    content = '|%s:%s|' % (hexval(qtype), ';'.join('%s=%s' % kv for kv in data))
+    # {, adresse (2), ;FB; (4), longueur (2), somme (4), }
+    l = len(content) + 1 + 2 + 4 + 2 + 4 + 1
+    if l > MAX_FRAME_LENGTH:
+        raise ValueError('answer too long: %i' % l)
+    answer = '%02i;FB;%s%s' % (int(idn), '%02X' % l, content)
+    return '{%s%s}' % (answer, checksum(answer))
+
+
+def setting_values(data):
+    '''Corps d'une trame d'écriture (qtype 200): {registre: valeur} -> 'KEY=hexa;...' '''
+    rawdata = []
+    for (key, value) in data.items():
+        key = key.upper()
+        if key not in query_set:
+            raise ValueError('unknown type')
+        # même échelle que la lecture: PAC en W, UL1 en V...
+        rawdata.append('%s=%s' % (key, encode_value(key, value)))
+    return ';'.join(rawdata)
+
+
+def inventory_entry(entry):
+    # champs de SolarMax.inverters() à partir d'une entrée d'inventaire
+    return dict(desc=entry['desc'], max=entry['max'], installed=entry['installed'])
+
+
+def status_values(values):
+    # registres demandés + ceux nécessaires à decode_status
+    return list(values) + [v for v in ('SYS', 'SAL') if v not in values]
+
+
+def alarm_names(mask):
+    '''Descriptions des alarmes d'un masque, dans l'ordre des bits'''
+    names = ()
+    for table in ALARM_TABLES:
+        if not mask:
+            break
+        names += table[mask & 0xFF]
+        mask >>= 8
+    return names
+
+
+def decode_status(result):
+    errors = alarm_names(result['SAL']) if result['SAL'] > 0 else ()
+
+    status = status_codes[result['SYS'][0]]
+
+    return (status, ', '.join(errors))
+
+
+class QueryCache(object):
+    '''
+        Trames de requête prêtes à l'envoi (bytes), construites et
+        contrôlées une seule fois par (onduleur, registres, qtype).
+        LRU borné à maxsize entrées.
+    '''
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.__frames = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return 'QueryCache[%i/%i / hits=%i / misses=%i]' % (len(self.__frames), self.maxsize, self.hits, self.misses)
+
+    def get(self, idn, values, qtype=100):
+        if type(values) not in [list, tuple]:
+            # écritures: le contenu change à chaque appel
+            return build_query(idn, values, qtype).encode()
+
+        key = (int(idn), tuple(values), qtype)
+        frame = self.__frames.get(key)
+        if frame is not None:
+            self.hits += 1
+            self.__frames.move_to_end(key)
+            return frame
+
+        self.misses += 1
+        frame = build_query(idn, list(values), qtype).encode()
+        self.__frames[key] = frame
+        if len(self.__frames) > self.maxsize:
+            self.__frames.popitem(last=False)
+        return frame
+
+    def clear(self):
+        self.__frames.clear()
+
+    def stats(self):
+        return dict(size=len(self.__frames), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
+
+
 ####################################
 ## main class
 ####################################
 class SolarMax ( object ):
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, frame_cache=None, inventory=None, register_cache=None):
         self.__host = host
         self.__port = port
+        self.frame_cache = frame_cache or QueryCache()
+        self.inventory = inventory
+        self.register_cache = register_cache
+        self.instruments = Instruments(host)
+        self.pipeline = PipelineScheduler(parse_answer, instruments=self.instruments)
+        self.connection = Connection(host, port)
+        self.health = {}
+        self.stale = 0
         self.__inverters = {}
-        self.__socket = None
-        self.__connected = False
         self.__allinverters = False
+        self.__detection_running = False
         self.__inverter_list = []
         self.__connect()
 
     def __repr__(self):
-        return 'SolarMax[%s:%s / socket=%s]' % (self.__host, self.__port, self.__socket)
+        return 'SolarMax[%s:%s / %r]' % (self.__host, self.__port, self.connection)
 
     def __str__(self):
-        return 'SolarMax[%s:%s / socket=%s / inverters=%s]' % (self.__host, self.__port, self.__socket, self.inverters())
+        return 'SolarMax[%s:%s / %r / inverters=%s]' % (self.__host, self.__port, self.connection, self.inverters())
 
-    def __disconnect(self):
-        try:
-            DEBUG('Closing open connection to %s:%s' % (self.__host, self.__port))
-            self.__socket.shutdown(socket.SHUT_RDWR)
-            self.__socket.close()
-            del self.__socket
-        except:
-            pass
-        finally:
-            self.__connected = False
-            self.__allinverters = False
-            self.__socket = None
+    def __disconnect(self, reason=''):
+        self.connection.close(reason)
 
     def __del__(self):
         DEBUG('destructor called')
         self.__disconnect()
 
     def __connect(self):
-        self.__disconnect()
-        DEBUG('establishing connection to %s:%i...' % (self.__host, self.__port))
-        try:
-            self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-            self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-            s = self.__socket
-            s.settimeout(2)
-            s.connect((self.__host, self.__port))
-            s.settimeout(10)
-
-            self.__connected = True
-            DEBUG('connected.')
-        except:
-            DEBUG('connection to %s:%i failed' % (self.__host, self.__port))
-            self.__connected = False
-            self.__allinverters = False
+        # connexion persistante: rouverte seulement si fermée et après le délai de reconnexion
+        return self.connection.connect()
+
+    def __health(self, inverter):
+        health = self.health.get(inverter)
+        if health is None:
+            health = self.health[inverter] = InverterHealth(inverter)
+        return health
+
+    def available(self, inverter):
+        '''Faux tant qu'un onduleur muet est en attente de sa prochaine tentative'''
+        return self.__health(inverter).ready()
+
+    def stats(self):
+        return dict(
+            connection=self.connection.stats(),
+            inverters={i: h.stats() for (i, h) in self.health.items()},
+            stale=self.stale,
+            instruments=self.instruments.snapshot(),
+            registers=self.register_cache.stats() if self.register_cache is not None else None,
+        )
+
+    def invalidate(self, inverter=None, keys=None):
+        '''Oublie les registres en cache de cet hôte (tous, ceux d'un onduleur, ou certains)'''
+        if self.register_cache is not None:
+            self.register_cache.invalidate(self.__host, inverter, keys)
 
 
     # Utility-functions
     def hexval(self, i):
-        return (hex(i)[2:]).upper()
+        return hexval(i)
 
 
     def checksum(self, s):
-        total = 0
-        for c in s:
-            total += ord(c)
-        h = self.hexval(total)
-        while len(h) < 4:
-            h = '0'+h
-        return h
-
-    def __read_char(self):
-        byte = self.__socket.recv(1)
-        if len(byte) > 0:
-            return ord(byte) & 0x7F
-        return 0
-
-    def __receive(self):
-        try:
-            data = []
-            while True:
-                c = self.__read_char()
-                if c:
-                    data.append(chr(c))
-                if not c or chr(c) == '}':
-                    break
-            return ''.join(data)
-
-        except:
-            self.__allinverters = False
-            return ''
+        return checksum(s)
+
+
+    def __receive(self, idn, values=None):
+        while True:
+            answer = self.connection.read_frame()
+            # réponse tardive d'un autre onduleur, ou du même à une autre requête
+            # (délai dépassé au cycle précédent, en pipeline)
+            if answer[1:3].isdigit() and (int(answer[1:3]) != int(idn) or (values and not set(answer_keys(answer)) <= values)):
+                self.stale += 1
+                self.instruments.error('stale')
+                DEBUG('stale answer dropped: %s' % answer)
+                continue
+            return answer
 
 
     def __parse(self, answer):
-        # convenience checks
-        if answer[0] != '{' or answer[-1] != '}':
-            raise ValueError('malformed answer: %s' % answer)
-        raw_answer = answer
-        answer = answer[1:-1]
-        checksum = answer[-4:]
-        content = answer[:-4]
-        # checksum
-        if checksum != self.checksum(content):
-            raise ValueError('checksum error')
-
-        (header, content) = content[:-1].split('|', 2)
-        (inverter, fb, length) = header.split(';', 3)
-        if fb != 'FB':
-            raise ValueError('answer not understood')
-        # length
-        length = int(length, 16)
-        if length != len(raw_answer):
-            raise ValueError('length mismatch')
-
-        inverter = int(inverter)
-
-        # Bei schreibzugriff antwortet der WR mit 'C8'
-        # Avec un accès en écriture, le WR répond par 'C8'
-        #if not content.startswith('64:'):
-        #  raise ValueError('Inverter did not understand our query')
-
-        content = content[3:]
-        data = {}
-
-        for item in content.split(';'):
-            (key, value) = item.split('=')
-            if key not in query_types:
-                raise NotImplementedError("Don't know %s" % item)
-            data[key] = value
-        return (inverter, data)
+        return parse_answer(answer)
 
 
     def __build_query(self, idn, values, qtype=100):
-        qtype = self.hexval(qtype)
-        if type(values) == list:
-            for v in values:
-                if v not in query_types:
-                    raise ValueError('Unknown data type »'+v+'«')
-            values = ';'.join(values)
-
-        #elif type(values) in [str, unicode]:
-        elif type(values) in [str,]:
-            pass
-        else:
-            raise ValueError('value has unsupported type')
-
-        querystring = '|' + qtype + ':' + values + '|'
-        # Länge vergrößern um: 2 x { (2), WR-Nummer (2), "FB" (2), zwei Semikolon (2), Länge selbst (2), checksumme (4)
-        # Augmentez la longueur de : 2 x { (2), le numéro WR (2), "FB" (2), deux points-virgules (2), la longueur elle-même (2), la somme de contrôle (4)
-        l = len(querystring) + 2 + 2 + 2 + 2 +2 + 4
-        querystring = 'FB;%02i;%s%s' % (int(idn), self.hexval(l), querystring)
-        querystring += self.checksum(querystring)
-        return '{%s}' % querystring
+        return build_query(idn, values, qtype)
 
 
     def __send_query(self, querystring):
-        try:
-            DEBUG(self.__host, '=>', querystring)
-            #self.__socket.send(querystring)
-            self.__socket.send(querystring.encode())
-        except socket.timeout:
-            self.__allinverters = False
-            self.__connected = False
+        DEBUG(self.__host, '=>', querystring)
+        self.connection.send(querystring)
 
 
     def query(self, idn, values, qtype=100):
-        q = self.__build_query(idn, values, qtype)
+        '''
+            (inverter, data) ou None si l'onduleur ne répond pas.
+            Avec un register_cache, seuls les registres absents ou périmés
+            sont demandés; aucune trame si tout est en cache.
+            Une lecture dont la réponse pourrait dépasser MAX_FRAME_LENGTH
+            est découpée en plusieurs trames (split_values).
+        '''
+        if qtype != 100 or type(values) not in [list, tuple]:
+            return self.__query(idn, values, qtype)
+        chunks = split_values(values)
+        if self.register_cache is None and len(chunks) == 1:
+            return self.__query(idn, values, qtype)
+        values = list(dict.fromkeys(values))
+        (found, missing) = self.register_cache.get(self.__host, idn, values) if self.register_cache is not None else ({}, values)
+        if not missing:
+            return (int(idn), merge(values, found))
+        # une trame par part: une réponse ne dépasse jamais MAX_FRAME_LENGTH
+        sample = {}
+        for chunk in split_values(missing):
+            result = self.__query(idn, chunk, qtype)
+            if not result:
+                return None
+            if self.register_cache is not None:
+                self.register_cache.update(self.__host, result[0], result[1])
+            sample.update(result[1].items())
+        return (result[0], merge(values, found, sample))
+
+
+    def __query(self, idn, values, qtype=100):
+        '''
+            Échange d'une trame sur le bus.
+            Un silence marque cet onduleur et ferme la connexion sans délai
+            de reconnexion: sa réponse tardive ne doit pas devenir celle de
+            la requête suivante. Une erreur réseau ferme la connexion,
+            rouverte avec un délai croissant.
+        '''
+        q = self.frame_cache.get(idn, values, qtype)
         DEBUG("WR %i: %s" % (idn, q))
+        health = self.__health(int(idn))
 
-        self.__send_query(q)
-        answer = self.__receive()
-
-        if answer:
-            (inverter, data) = self.__parse(answer)
-            for d in data.keys():
-                data[d] = self.normalize_value(d, data[d])
-            return (inverter, data)
-        else:
+        if not self.__connect():
+            health.failure('no connection')
+            return None
+        started = time.monotonic()
+        try:
+            self.__send_query(q)
+            answer = self.__receive(idn, set(values) if qtype == 100 and type(values) in [list, tuple] else None)
+        except socket.timeout:
             self.__allinverters = False
+            self.instruments.error('timeout')
+            self.__disconnect('timeout')
+            health.failure('timeout')
+            return None
+        except OSError as e:
+            self.__disconnect(str(e))
+            health.failure(str(e))
+            return None
+
+        if not answer:
+            self.instruments.error('empty_read')
+            self.__disconnect('closed by peer')
+            health.failure('closed by peer')
+            return None
 
-        if not self.__allinverters and not self.__detection_running:
-            self.detect_inverters()
-        elif not self.__connected:
-            self.__connect()
-        else:
-            raise socket.timeout
-        return None
+        try:
+            (inverter, data) = self.__parse(answer)
+        except Exception as e:
+            self.instruments.error(classify(e))
+            health.failure(str(e))
+            raise
+        self.instruments.observe(int(idn), time.monotonic() - started)
+        health.success()
+        return (inverter, decode(data))
 
 
     def normalize_value(self, key, value):
-        if key in [ 'KDY', 'UL1', 'UDC']:
-            return float(int(value, 16)/10)
-
-        elif key in [ 'IL1', 'IDC', 'TNF', ]:
-            return float(int(value, 16)/100)
-
-        elif key in [ 'PAC', 'PIN', ]:
-            return float(int(value, 16)/2)
-
-        elif key in [ 'SAL', ]:
-            return int(value, 16)
-
-        elif key in [ 'SYS', ]:
-            (x,y) = value.split(',',2)
-            x = int(x, 16)
-            y = int(y, 16)
-            return (x,y)
-
-        elif key in [ 'SDAT', 'FDAT' ]:
-            (date, time) = value.split(',',2)
-            time = int(time, 16)
-            return datetime.datetime(int(date[:3], 16), int(date[3:5], 16), int(date[5:], 16), time//3600, (time % 3600) // 60, time % (3600*60))
-        else:
-            return int(value, 16)
+        return normalize_value(key, value)
 
 
     def write_setting(self, inverter, data):
-        rawdata = []
-        for key,value in data.iteritems():
-            key = key.upper()
-            if key not in query_types:
-                raise ValueError('unknown type')
-            value = self.hexval(value)
-            rawdata.append('%s=%s' % (key, value))
+        '''
+            Écrit {registre: valeur}; l'onduleur renvoie les valeurs prises
+            en compte: (inverter, data) ou None
+        '''
+        result = self.query(inverter, setting_values(data), 200)
+        DEBUG(result)
+        self.invalidate(inverter, [k.upper() for k in data])
+        return result
+
+
+    def poll(self, inverter, values):
+        '''
+            Télémesure, status et alarmes en une seule trame:
+            (inverter, data, status, errors) ou None
+        '''
+        result = self.query(inverter, status_values(values))
+        if not result:
+            return None
+        (inverter, data) = result
+        return (inverter, data) + decode_status(data)
+
+
+    def poll_many(self, inverters, values):
+        '''
+            poll() de plusieurs onduleurs de la même passerelle en pipeline:
+            {inverter: (inverter, data, status, errors) ou None}
+        '''
+        results = {int(idn): None for idn in inverters}
+        # un onduleur muet attend son délai de reprise: ni trame ni délai d'attente
+        ready = [int(idn) for idn in inverters if self.available(int(idn))]
+        raw = {idn: {} for idn in ready}
+        failures = {}
+        # une passe de pipeline par part des registres (réponses de 255 caractères au plus)
+        for chunk in split_values(status_values(values)):
+            pending = [idn for idn in ready if idn not in failures]
+            if not pending:
+                break
+            if not self.__connect():
+                failures.update(dict.fromkeys(pending, 'no connection'))
+                break
+            requests = [(idn, self.frame_cache.get(idn, chunk)) for idn in pending]
+            errors = self.pipeline.stats['errors']
+            try:
+                answers = self.pipeline.run(self.connection.sock, self.connection.reader, requests, set(chunk))
+            except OSError as e:
+                DEBUG('pipeline on %s failed: %s' % (self.__host, e))
+                self.__disconnect(str(e))
+                failures.update(dict.fromkeys(pending, str(e)))
+                break
+            DEBUG(self.pipeline)
+            if self.pipeline.stats['errors'] > errors:
+                # trame illisible: le flux peut être décalé. Une réponse manquante ne ferme
+                # rien, sa version tardive sera écartée (adresse et registres)
+                self.__disconnect('framing error')
+            for idn in pending:
+                answer = answers.get(idn)
+                if answer:
+                    raw[idn].update(answer[1])
+                else:
+                    failures[idn] = 'timeout'
 
-        DEBUG(self.query(inverter, ';'.join(rawdata), 200))
+        for idn in ready:
+            if idn in failures:
+                self.__health(idn).failure(failures[idn])
+                self.__allinverters = False
+                continue
+            self.__health(idn).success()
+            data = decode(raw[idn])
+            if self.register_cache is not None:
+                self.register_cache.update(self.__host, idn, data)
+            results[idn] = (idn, data) + decode_status(data)
+        return results
 
 
     def status(self, inverter):
-        result = self.query(inverter, ['SYS', 'SAL'])
+        result = self.poll(inverter, [])
         if not result:
             return ('Offline', 'Offline')
 
-        result = result[1]
-        errors = []
-        if result['SAL'] > 0:
-            for (code, descr) in alarm_codes.iteritems():
-                if code & result['SAL']:
-                    errors.append(descr)
-
-        status = status_codes[result['SYS'][0]]
-
-        return (status, ', '.join(errors))
+        return result[2:]
 
 
     def use_inverters(self, list_of):
         self.__inverter_list = list_of
-        self.detect_inverters()
+        if self.inventory is None:
+            self.detect_inverters()
+            return
+        # démarrage immédiat depuis l'inventaire, les absents seront cherchés par inverters()
+        cached = self.inventory.get(self.__host)
+        self.__inverters = {i: inventory_entry(cached[i]) for i in list_of if i in cached}
+        self.__allinverters = len(self.__inverters) == len(list_of)
+        DEBUG('inventory %s: %s' % (self.__host, self.__inverters))
 
 
-    def detect_inverters(self):
-        self.__inverters = {}
-        if not self.__connected:
-            self.__connect()
+    def revalidate(self, limit=1):
+        '''Réinterroge au plus 'limit' onduleurs dont l'inventaire est périmé'''
+        if self.inventory is None:
+            return
+        stale = [i for i in self.inventory.stale(self.__host, self.__inverters) if self.available(i)]
+        if stale:
+            self.detect_inverters(stale[:limit])
+
+
+    def detect_inverters(self, inverters=None):
+        '''Recherche les onduleurs donnés (tous par défaut) sans toucher à la connexion'''
+        if inverters is None:
+            self.__inverters = {}
+            inverters = self.__inverter_list
 
         self.__detection_running = True
-        for inverter in self.__inverter_list:
+        for inverter in inverters:
             try:
-                DEBUG('searching for #%i (socket: %s)' % (inverter, self.__socket))
+                DEBUG('searching for #%i (%r)' % (inverter, self.connection))
+                # la revalidation de l'inventaire doit lire le bus, pas le cache
+                self.invalidate(inverter, [ 'ADR', 'TYP', 'PIN' ])
                 (inverter, data) = self.query(inverter, [ 'ADR', 'TYP', 'PIN' ])
 
                 if data['TYP'] in inverter_types.keys():
                     self.__inverters[inverter] = inverter_types[data['TYP']].copy()
                     self.__inverters[inverter]['installed'] = data['PIN']
+                    if self.inventory is not None:
+                        self.inventory.update(self.__host, inverter, dict(self.__inverters[inverter], typ=data['TYP']))
                 else:
                     DEBUG('Unknown inverter type: %s (ID #%i)' % (data['TYP'], data['ADR']))
 
             except Exception as e:
                 DEBUG('Inverter #%i not found: %s' % (inverter, e))
 
-                self.__allinverters = False
-
         self.__detection_running = False
 
-        if len(self.__inverters) == len(self.__inverter_list):
-            self.__allinverters = True
+        self.__allinverters = all(i in self.__inverters for i in self.__inverter_list)
+        if self.__allinverters:
             DEBUG('found all inverters:')
             DEBUG(self.__inverters)
         else:
-            DEBUG('not all invertes found, reconnection!')
-        self.__connect()
+            DEBUG('not all inverters found, missing ones will be probed again after their backoff')
 
 
     def inverters(self):
         if not self.__allinverters:
-            self.detect_inverters()
+            # seuls les onduleurs absents et dont le délai est écoulé sont recherchés
+            missing = [i for i in self.__inverter_list if i not in self.__inverters and self.available(i)]
+            if missing:
+                self.detect_inverters(missing)
         return self.__inverters
-
-
-
-
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Suite de benchmarks: microbenchmarks du codec et cycles complets du démon.
+Les résultats sont écrits en JSON; avec --baseline, toute métrique qui se
+dégrade de plus de --threshold (20% par défaut) est signalée et le code
+de sortie vaut 1.
+
+    cd solarmax
+    python -m bench --output bench.json
+    python -m bench --output new.json --baseline bench.json
+'''
+import sys, json, time, platform, argparse, logging
+from . import micro, cycle, recv_frames, decode, encoding
+
+# sens d'amélioration de chaque métrique
+HIGHER_IS_BETTER = {'ops_per_s', 'samples_per_s', 'cycles_per_s'}
+LOWER_IS_BETTER = {'bytes_per_message', 'us_per_op', 'us_per_frame', 'syscalls_per_frame', 'p50_ms', 'p99_ms', 'cpu_s_per_cycle', 'peak_rss_kb'}
+
+
+def compare(baseline, results, threshold):
+    regressions = []
+    for (name, metrics) in results.items():
+        for (metric, value) in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old or not isinstance(value, (int, float)):
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = (old - value) / old
+            elif metric in LOWER_IS_BETTER:
+                change = (value - old) / old
+            else:
+                continue
+            if change > threshold:
+                regressions.append(dict(name=name, metric=metric, baseline=old, value=value, change=change))
+    return regressions
+
+
+def main(args):
+    results = {}
+    print('--- micro')
+    results.update(micro.main(args.repeat))
+    for r in recv_frames.main(args.repeat // 4):
+        results['recv ' + r.pop('name')] = r
+    for r in decode.main(args.repeat):
+        results['decode ' + r.pop('name')] = r
+    for (name, r) in encoding.main(args.repeat).items():
+        results['encode ' + name] = r
+    if not args.skip_e2e:
+        print('--- cycle')
+        inverters = [int(i) for i in args.inverters.split(',')]
+        results.update(cycle.main(args.hosts, inverters, args.duration, args.latency, port=args.port))
+        results.update(cycle.instruments_overhead(args.hosts, inverters, args.duration, args.latency, port=args.port))
+
+    document = dict(
+        created=int(time.time()),
+        python=platform.python_version(),
+        machine=platform.machine(),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(baseline, results, args.threshold)
+        for r in regressions:
+            print(f"REGRESSION {r['name']} {r['metric']}: {r['baseline']:.4g} -> {r['value']:.4g} ({r['change']:+.0%})")
+        if regressions:
+            return 1
+        print(f'pas de régression au-delà de {args.threshold:.0%}')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description="Benchmarks pi-solarmax")
+    parser.add_argument("--output", default='bench.json', help="Fichier JSON des résultats")
+    parser.add_argument("--baseline", default=None, help="Résultats de référence (JSON) à comparer")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Dégradation tolérée (0.2 = 20%%)")
+    parser.add_argument("--repeat", type=int, default=20000, help="Itérations des microbenchmarks")
+    parser.add_argument("--skip-e2e", action='store_true', help="Microbenchmarks seulement")
+    parser.add_argument("--hosts", type=int, default=10, help="Hôtes simulés (bout en bout)")
+    parser.add_argument("--inverters", default='1,2', help="Identifiants par hôte (bout en bout)")
+    parser.add_argument("--duration", type=float, default=5.0, help="Durée par mode (s)")
+    parser.add_argument("--latency", type=float, default=0.005, help="Latence simulée par réponse (s)")
+    parser.add_argument("--port", type=int, default=22345, help="Port TCP du simulateur")
+    sys.exit(main(parser.parse_args()))
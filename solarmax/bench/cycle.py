@@ -0,0 +1,218 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Benchmark de bout en bout: cycles complets de SolarmaxDaemon contre le
+simulateur (lancé dans un processus séparé pour ne pas fausser le CPU).
+
+    cd solarmax
+    python -m bench.cycle --hosts 20 --inverters 1,2 --duration 10 --mode async
+
+Avec --instruments, le même cycle est mesuré avec et sans les
+histogrammes de latence et compteurs d'erreurs (Instruments): l'écart
+relatif de CPU par cycle est leur coût.
+'''
+import os, sys, time, socket, asyncio, resource, subprocess, argparse, logging
+from solarmaxd import SolarmaxDaemon
+from SolarMax.instrumentation import Instruments
+from .micro import measure
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def start_simulator(hosts, inverters, port, latency):
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'SolarMax.simulator', '--hosts', str(hosts), '--inverters', ','.join(map(str, inverters)),
+         '--port', str(port), '--hour', '13', '--latency', str(latency)],
+        cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    last = '127.0.0.%i' % hosts
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((last, port), 0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.terminate()
+    raise RuntimeError('le simulateur ne répond pas')
+
+
+def make_settings(hosts, inverters, port, mode, pipeline_window):
+    return dict(
+        solarmax=dict(
+            inverters={'127.0.0.%i' % (n + 1): list(inverters) for n in range(hosts)},
+            loop_timeout=0, uuid=1, ip='127.0.0.1', origine='bench', topic_base='bench/0x1', topic_subs=[],
+            port=port, host_timeout=15, pipeline_window=pipeline_window, **{'async': mode == 'async'},
+        ),
+        # aucun broker: les publications sont sérialisées puis abandonnées par paho
+        mqtt=dict(host='127.0.0.1', port=1, keepalive=60),
+    )
+
+
+class NullInstruments(Instruments):
+    '''Instruments sans mesure: référence du coût de l'instrumentation'''
+
+    def observe(self, inverter, elapsed):
+        pass
+
+    def error(self, kind):
+        pass
+
+
+def disable_instruments(clients):
+    for client in clients:
+        client.instruments = NullInstruments(client.instruments.host)
+        if getattr(client, 'pipeline', None) is not None:
+            client.pipeline.instruments = client.instruments
+
+
+def timed(fn, latencies):
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - t0)
+    return wrapper
+
+
+def timed_async(fn, latencies):
+    async def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - t0)
+    return wrapper
+
+
+def run_cycles(daemon, poll_cycle, duration):
+    cycles = 0
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < duration:
+        try:
+            daemon.publish_cycle(*poll_cycle())
+        except Exception as e:
+            logging.warning(e)
+        cycles += 1
+    return cycles, time.perf_counter() - t0, time.process_time() - cpu0
+
+
+async def run_cycles_async(daemon, duration):
+    cycles = 0
+    cpu0 = time.process_time()
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < duration:
+        try:
+            daemon.publish_cycle(*await daemon.poll_cycle_async())
+        except Exception as e:
+            logging.warning(e)
+        cycles += 1
+    return cycles, time.perf_counter() - t0, time.process_time() - cpu0
+
+
+def run(mode='sync', hosts=10, inverters=(1,), duration=5.0, latency=0.0, pipeline_window=1, port=22345, instruments=True):
+    proc = start_simulator(hosts, inverters, port, latency)
+    latencies = []
+    try:
+        daemon = SolarmaxDaemon('bench.yaml', **make_settings(hosts, inverters, port, mode, pipeline_window))
+        if not instruments:
+            disable_instruments(daemon.smlist)
+        if mode == 'async':
+            async def go():
+                await daemon.connect_async()
+                if not instruments:
+                    disable_instruments(daemon.asmlist)
+                for asm in daemon.asmlist:
+                    asm.poll = timed_async(asm.poll, latencies)
+                result = await run_cycles_async(daemon, duration)
+                await asyncio.gather(*(asm.close() for asm in daemon.asmlist))
+                return result
+            (cycles, elapsed, cpu) = asyncio.run(go())
+        else:
+            for sm in daemon.smlist:
+                sm.poll = timed(sm.poll, latencies)
+                sm.poll_many = timed(sm.poll_many, latencies)
+            (cycles, elapsed, cpu) = run_cycles(daemon, daemon.poll_cycle, duration)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    clients = daemon.smlist or daemon.asmlist
+    return dict(
+        cycles=cycles,
+        observations=sum(client.instruments.latency.count for client in clients),
+        cycles_per_s=cycles / elapsed,
+        queries=len(latencies),
+        p50_ms=percentile(latencies, 0.50) * 1000,
+        p99_ms=percentile(latencies, 0.99) * 1000,
+        cpu_s_per_cycle=cpu / max(cycles, 1),
+        peak_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    )
+
+
+def main(hosts, inverters, duration, latency, modes=('sync', 'async'), port=22345):
+    results = {}
+    for mode in modes:
+        name = f'cycle_{mode}_{hosts}x{len(inverters)}'
+        results[name] = r = run(mode, hosts, inverters, duration, latency, port=port)
+        print(f"{name:24s} {r['cycles_per_s']:8.2f} cycles/s  p50 {r['p50_ms']:7.2f} ms  p99 {r['p99_ms']:7.2f} ms  "
+              f"cpu {r['cpu_s_per_cycle']*1000:7.2f} ms/cycle  rss {r['peak_rss_kb']} kB")
+    return results
+
+
+def instruments_overhead(hosts, inverters, duration, latency, mode='sync', port=22345, rounds=5):
+    '''
+        Écart relatif de CPU par cycle, instrumenté contre non instrumenté.
+        Les deux variantes alternent sur plusieurs manches pour que la dérive
+        de la machine pèse autant sur l'une que sur l'autre; la meilleure
+        manche de chacune est retenue. Cet écart a quelques % de bruit: le
+        coût estimé (mesures par cycle x coût d'une mesure) le complète.
+    '''
+    cpu = {True: [], False: []}
+    observations = 0
+    for _ in range(rounds):
+        for enabled in (False, True):
+            r = run(mode, hosts, inverters, duration / rounds, latency, port=port, instruments=enabled)
+            cpu[enabled].append(r['cpu_s_per_cycle'])
+            if enabled:
+                observations += r['observations'] / max(r['cycles'], 1)
+    (on, off) = (min(cpu[True]), min(cpu[False]))
+    instruments = Instruments('bench')
+    observe = measure(lambda: (instruments.observe(1, 0.042), instruments.error('timeout')), 100000)['us_per_op'] * 1e-6
+    name = f'instruments_{mode}_{hosts}x{len(inverters)}'
+    r = dict(
+        cpu_s_per_cycle=on, cpu_s_per_cycle_disabled=off,
+        overhead=(on - off) / off if off else 0.0,
+        estimated_overhead=observations / rounds * observe / off if off else 0.0,
+    )
+    print(f"{name:24s} cpu {on*1000:7.3f} ms/cycle, sans instruments {off*1000:7.3f} ms/cycle  "
+          f"écart {r['overhead']:+.2%}  estimé {r['estimated_overhead']:.2%}")
+    return {name: r}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cycle complet SolarmaxDaemon contre le simulateur")
+    parser.add_argument("--hosts", type=int, default=10, help="Nombre d'hôtes simulés")
+    parser.add_argument("--inverters", default='1', help="Identifiants par hôte, ex: 1,2")
+    parser.add_argument("--duration", type=float, default=5.0, help="Durée de mesure par mode (s)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Latence simulée par réponse (s)")
+    parser.add_argument("--mode", choices=['sync', 'async', 'both'], default='both', help="Boucle du démon")
+    parser.add_argument("--port", type=int, default=22345, help="Port TCP du simulateur")
+    parser.add_argument("--instruments", action='store_true', help="Coût de l'instrumentation (avec / sans)")
+    args = parser.parse_args()
+    modes = ('sync', 'async') if args.mode == 'both' else (args.mode,)
+    inverters = [int(i) for i in args.inverters.split(',')]
+    if args.instruments:
+        for mode in modes:
+            instruments_overhead(args.hosts, inverters, args.duration, args.latency, mode, args.port)
+    else:
+        main(args.hosts, inverters, args.duration, args.latency, modes, args.port)
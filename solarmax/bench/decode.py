@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Benchmark: décodage d'une réponse, chaîne de if (normalize_value historique)
+contre le registre de codecs (SolarMax.codec.decode)
+
+    cd solarmax
+    python -m bench.decode --samples 50000
+'''
+import time, datetime, argparse
+from SolarMax.solarmax_fr import parse_answer
+from SolarMax.codec import decode
+
+
+ANSWER = '{01;FB;6C|64:PAC=1F4;TKK=2A;KDY=3C;KT0=1F40;IDC=1F4;UDC=D48;IL1=1F4;UL1=8FC;FDAT=7DB0A1F,2A;SYS=4E24,0|1975}'
+
+
+def legacy_normalize_value(key, value):
+    # copie de l'ancien SolarMax.normalize_value
+    if key in [ 'KDY', 'UL1', 'UDC']:
+        return float(int(value, 16)/10)
+    elif key in [ 'IL1', 'IDC', 'TNF', ]:
+        return float(int(value, 16)/100)
+    elif key in [ 'PAC', 'PIN', ]:
+        return float(int(value, 16)/2)
+    elif key in [ 'SAL', ]:
+        return int(value, 16)
+    elif key in [ 'SYS', ]:
+        (x,y) = value.split(',',2)
+        return (int(x, 16), int(y, 16))
+    elif key in [ 'SDAT', 'FDAT' ]:
+        (date, time) = value.split(',',2)
+        time = int(time, 16)
+        return datetime.datetime(int(date[:3], 16), int(date[3:5], 16), int(date[5:], 16), time//3600, (time % 3600) // 60, time % (3600*60))
+    else:
+        return int(value, 16)
+
+
+def legacy_decode(data):
+    data = dict(data)
+    for d in data.keys():
+        data[d] = legacy_normalize_value(d, data[d])
+    return data
+
+
+def run(name, samples, fn, data):
+    t0 = time.perf_counter()
+    for _ in range(samples):
+        fn(data)
+    elapsed = time.perf_counter() - t0
+    return dict(name=name, samples=samples, samples_per_s=samples / elapsed)
+
+
+def main(samples):
+    (_, data) = parse_answer(ANSWER)
+    if tuple(legacy_decode(data).values()) != tuple(decode(data)):
+        raise ValueError('les deux décodages diffèrent')
+    results = [
+        run('normalize_value', samples, legacy_decode, data),
+        run('codec.decode', samples, decode, data),
+    ]
+    for r in results:
+        print(f"{r['name']:16s} {r['samples']} réponses  {r['samples_per_s']:12.0f} réponses/s")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="normalize_value vs codec.decode")
+    parser.add_argument("--samples", type=int, default=50000, help="Nombre de réponses décodées")
+    args = parser.parse_args()
+    main(args.samples)
@@ -0,0 +1,40 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Benchmark: encodage d'un message 'production', json contre l'enregistrement
+binaire StructCodec (temps d'encodage et octets par message)
+
+    cd solarmax
+    python -m bench.encoding --messages 50000
+'''
+import json, argparse
+from contrib.binpack import StructCodec
+from solarmaxd import DATAS
+from .micro import measure
+
+PAYLOAD = dict(inv=1, ivmax=1980.0, tmpr=46, pac=1759.5, eac=88, pdc=1852.6, edc=94, qdy=12.4, qt0=8000, stat=20004, time=1792326887, full=True)
+
+
+def main(messages):
+    codec = StructCodec(DATAS)
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    cases = {
+        'json': lambda: encode(PAYLOAD).encode('utf-8'),
+        'struct': lambda: codec.encode(PAYLOAD),
+    }
+    decoded = codec.decode(codec.encode(PAYLOAD))
+    if set(decoded) != set(PAYLOAD) or decoded['qt0'] != PAYLOAD['qt0']:
+        raise ValueError('aller-retour StructCodec incorrect')
+    results = {}
+    for (name, fn) in cases.items():
+        results[name] = r = measure(fn, messages)
+        r['bytes_per_message'] = len(fn())
+        print(f"{name:8s} {r['ops_per_s']:12.0f} messages/s  {r['us_per_op']:6.2f} µs/message  {r['bytes_per_message']:4d} octets")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="json vs StructCodec")
+    parser.add_argument("--messages", type=int, default=50000, help="Nombre de messages encodés")
+    args = parser.parse_args()
+    main(args.messages)
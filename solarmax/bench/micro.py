@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Microbenchmarks du codec protocole:
+checksum, build_query (et QueryCache), parse_answer, normalize_value, decode,
+alarm_names
+
+    cd solarmax
+    python -m bench.micro --repeat 20000
+'''
+import time, argparse
+from SolarMax.solarmax_fr import checksum, build_query, parse_answer, alarm_names, QueryCache
+from SolarMax.codec import normalize_value, decode
+from SolarMax.instrumentation import Histogram
+from .decode import ANSWER
+
+POLL_VALUES = ['PAC', 'TKK', 'KDY', 'KT0', 'IDC', 'UDC', 'IL1', 'UL1', 'FDAT', 'SYS', 'SAL']
+
+
+def measure(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = time.perf_counter() - t0
+    return dict(ops_per_s=repeat / elapsed, us_per_op=elapsed / repeat * 1e6)
+
+
+def main(repeat):
+    content = ANSWER[1:-5]
+    (_, data) = parse_answer(ANSWER)
+    items = list(data.items())
+    cache = QueryCache()
+    histogram = Histogram()
+    cases = {
+        'checksum': lambda: checksum(content),
+        'build_query': lambda: build_query(1, POLL_VALUES),
+        'build_query_cached': lambda: cache.get(1, POLL_VALUES),
+        'parse_answer': lambda: parse_answer(ANSWER),
+        'normalize_value': lambda: [normalize_value(k, v) for (k, v) in items],
+        'decode': lambda: decode(data),
+        'histogram_observe': lambda: histogram.observe(0.042),
+        'alarm_names': lambda: alarm_names(0x10102),
+    }
+    results = {}
+    for (name, fn) in cases.items():
+        results[name] = r = measure(fn, repeat)
+        print(f"{name:20s} {r['ops_per_s']:12.0f} ops/s  {r['us_per_op']:8.2f} µs/op")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Microbenchmarks du codec SolarMax")
+    parser.add_argument("--repeat", type=int, default=20000, help="Nombre d'itérations par cas")
+    args = parser.parse_args()
+    main(args.repeat)
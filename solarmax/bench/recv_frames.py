@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Benchmark: lecture octet par octet (recv(1)) contre FrameReader
+
+    cd solarmax
+    python -m bench.recv_frames --frames 5000
+'''
+import socket, threading, time, argparse
+from SolarMax.framing import FrameReader
+
+
+ANSWER = '{01;FB;6E|64:PAC=1F4;TKK=2A;KDY=3C;KT0=1F40;IDC=1F4;UDC=D48;IL1=1F4;UL1=8FC;FDAT=7DB0A1F,B5F0;SYS=4E24,0|19F1}'
+
+
+class CountingSocket(object):
+    '''Enveloppe comptant les appels système de lecture'''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def recv(self, n):
+        self.calls += 1
+        return self.sock.recv(n)
+
+    def recv_into(self, buf):
+        self.calls += 1
+        return self.sock.recv_into(buf)
+
+
+def legacy_read_frame(sock):
+    # copie de l'ancien SolarMax.__receive / __read_char
+    data = []
+    while True:
+        byte = sock.recv(1)
+        c = ord(byte) & 0x7F if len(byte) > 0 else 0
+        if c:
+            data.append(chr(c))
+        if not c or chr(c) == '}':
+            break
+    return ''.join(data)
+
+
+def writer(sock, frames, pingpong):
+    payload = ANSWER.encode()
+    for _ in range(frames):
+        if pingpong:
+            sock.recv(1)
+        sock.sendall(payload)
+
+
+def run(name, frames, read_frame, pingpong=False):
+    a, b = socket.socketpair()
+    counting = CountingSocket(a)
+    t = threading.Thread(target=writer, args=(b, frames, pingpong), daemon=True)
+    t.start()
+    read = read_frame(counting)
+    t0 = time.perf_counter()
+    for _ in range(frames):
+        if pingpong:
+            a.send(b'?')
+        if read() != ANSWER:
+            raise ValueError('%s: trame inattendue' % name)
+    elapsed = time.perf_counter() - t0
+    t.join()
+    a.close()
+    b.close()
+    return dict(
+        name=name + (' question/réponse' if pingpong else ' flux'),
+        frames=frames,
+        syscalls_per_frame=counting.calls / frames,
+        us_per_frame=elapsed / frames * 1e6,
+    )
+
+
+def main(frames):
+    results = []
+    for pingpong in (False, True):
+        results.append(run('recv(1)', frames, lambda s: lambda: legacy_read_frame(s), pingpong))
+        results.append(run('FrameReader', frames, lambda s: FrameReader(s).read_frame, pingpong))
+    for r in results:
+        print(f"{r['name']:32s} {r['frames']} trames  {r['syscalls_per_frame']:8.2f} syscalls/trame  {r['us_per_frame']:9.2f} µs/trame")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="recv(1) vs FrameReader")
+    parser.add_argument("--frames", type=int, default=5000, help="Nombre de trames")
+    args = parser.parse_args()
+    main(args.frames)
@@ -0,0 +1,92 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Mise à l'échelle du mode multi-processus: cycles publiés par le
+superviseur pour 1, 2, 4... processus d'interrogation, contre le
+simulateur. Avec une latence par réponse (bus RS485), la durée d'un cycle
+en mode synchrone suit le nombre d'hôtes par processus.
+
+    cd solarmax
+    python -m bench.shards --hosts 16 --inverters 1,2 --latency 0.005 --processes 1,2,4
+'''
+import time, threading, argparse, logging
+from sharding import ShardSupervisor
+from .cycle import start_simulator, make_settings
+
+
+def run(processes, hosts=16, inverters=(1,), duration=5.0, latency=0.005, mode='sync', port=22345):
+    settings = make_settings(hosts, inverters, port, mode, 1)
+    settings['solarmax']['processes'] = processes
+    supervisor = ShardSupervisor('bench.yaml', **settings)
+    samples = []
+    publish_cycle = supervisor.publish_cycle
+
+    def counted(count, payloads):
+        samples.append(len(payloads))
+        return publish_cycle(count, payloads)
+    supervisor.publish_cycle = counted
+
+    thread = threading.Thread(target=supervisor.run_forever, daemon=True)
+    thread.start()
+    try:
+        # démarrage des processus (spawn) hors mesure
+        deadline = time.monotonic() + 30
+        while not all(state.cycles for state in supervisor.shards) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        (cycles0, samples0) = (supervisor.cycles, sum(samples))
+        durations = [s.cycle_duration.sum for s in supervisor.shards]
+        counts = [s.cycle_duration.count for s in supervisor.shards]
+        t0 = time.perf_counter()
+        time.sleep(duration)
+        elapsed = time.perf_counter() - t0
+        cycles = supervisor.cycles - cycles0
+        shard_means = [
+            (s.cycle_duration.sum - d) / max(s.cycle_duration.count - c, 1)
+            for (s, d, c) in zip(supervisor.shards, durations, counts)
+        ]
+        restarts = sum(s.restarts for s in supervisor.shards)
+    finally:
+        supervisor.stop()
+        thread.join(5)
+    return dict(
+        processes=len(supervisor.shards),
+        cycles=cycles,
+        cycles_per_s=cycles / elapsed,
+        cycle_ms=1000 * elapsed / max(cycles, 1),
+        shard_cycle_ms=1000 * max(shard_means),
+        samples_per_s=(sum(samples) - samples0) / elapsed,
+        restarts=restarts,
+    )
+
+
+def main(hosts, inverters, duration, latency, processes=(1, 2, 4), mode='sync', port=22345):
+    results = {}
+    proc = start_simulator(hosts, inverters, port, latency)
+    try:
+        for n in processes:
+            name = f'shards_{mode}_{n}p_{hosts}x{len(inverters)}'
+            results[name] = r = run(n, hosts, inverters, duration, latency, mode, port)
+            print(f"{name:28s} {r['cycles_per_s']:8.2f} cycles/s  cycle {r['cycle_ms']:8.2f} ms  "
+                  f"shard {r['shard_cycle_ms']:8.2f} ms  {r['samples_per_s']:9.1f} samples/s")
+    finally:
+        proc.terminate()
+        proc.wait()
+    first = results[next(iter(results))]
+    for (name, r) in results.items():
+        print(f"{name:28s} accélération x{first['cycle_ms'] / r['cycle_ms']:.2f} pour {r['processes']} processus")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Mise à l'échelle du mode multi-processus")
+    parser.add_argument("--hosts", type=int, default=16, help="Nombre d'hôtes simulés")
+    parser.add_argument("--inverters", default='1', help="Identifiants par hôte, ex: 1,2")
+    parser.add_argument("--duration", type=float, default=5.0, help="Durée de mesure par configuration (s)")
+    parser.add_argument("--latency", type=float, default=0.005, help="Latence simulée par réponse (s)")
+    parser.add_argument("--processes", default='1,2,4', help="Nombres de processus à mesurer, ex: 1,2,4")
+    parser.add_argument("--mode", choices=['sync', 'async'], default='sync', help="Boucle des processus d'interrogation")
+    parser.add_argument("--port", type=int, default=22345, help="Port TCP du simulateur")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    main(args.hosts, [int(i) for i in args.inverters.split(',')], args.duration, args.latency,
+         [int(n) for n in args.processes.split(',')], args.mode, args.port)
@@ -0,0 +1,82 @@
+#
+# encodage binaire compact des messages (struct)
+#
+'''
+Enregistrement à plat, petit-boutiste, dont la disposition est tirée de la
+liste 'datas' publiée dans le rapport du capteur: chaque entrée qui porte
+une clé 'pack' (format struct: 'I', 'H', 'f', 'b', '?'...) est un champ,
+dans l'ordre de la liste.
+
+    octet 0      version du schéma
+    octets 1-4   masque des champs présents (bit n = n-ième champ 'pack')
+    ...          valeurs des champs présents, dans l'ordre
+
+Le masque permet les messages partiels (bande morte) et les agrégats qui
+n'ont qu'une partie des champs. Un consommateur décode avec la même
+liste 'datas' et la même version. Un entier hors de la plage de son
+format (rendement aberrant, température sous -128 °C) est ramené à la
+borne la plus proche plutôt que de faire échouer tout l'enregistrement.
+'''
+import math, struct
+
+HEADER = struct.Struct('<BI')
+INTEGERS = set('bBhHiIlLqQ')
+
+
+def integer_range(fmt):
+    '''Bornes (min, max) d'un format struct entier'''
+    bits = 8 * struct.calcsize('<' + fmt)
+    if fmt.islower():
+        return (-1 << bits - 1, (1 << bits - 1) - 1)
+    return (0, (1 << bits) - 1)
+
+
+class StructCodec(object):
+
+    def __init__(self, datas, version=1):
+        self.version = version
+        self.fields = [(d['name'], d['pack']) for d in datas if d.get('pack')]
+        if len(self.fields) > 32:
+            raise ValueError('32 champs au plus dans un enregistrement')
+        self.index = {name: n for (n, (name, _)) in enumerate(self.fields)}
+        # formats struct déjà compilés, par masque de champs présents
+        self.__layouts = {}
+
+    def __repr__(self):
+        return 'StructCodec[v%i / %i fields]' % (self.version, len(self.fields))
+
+    def layout(self, mask):
+        entry = self.__layouts.get(mask)
+        if entry is None:
+            present = [(n, name, fmt) for (n, (name, fmt)) in enumerate(self.fields) if mask >> n & 1]
+            entry = self.__layouts[mask] = (
+                struct.Struct('<' + ''.join(fmt for (_, _, fmt) in present)),
+                tuple(name for (_, name, _) in present),
+                tuple(integer_range(fmt) if fmt in INTEGERS else None for (_, _, fmt) in present),
+            )
+        return entry
+
+    def encode(self, payload):
+        index = self.index
+        mask = 0
+        for key in payload:
+            n = index.get(key)
+            if n is not None:
+                mask |= 1 << n
+        (layout, names, ranges) = self.layout(mask)
+        values = []
+        for (name, bounds) in zip(names, ranges):
+            value = payload[name]
+            if value is None:
+                value = 0 if bounds else math.nan
+            elif bounds:
+                value = min(max(int(round(value)), bounds[0]), bounds[1])
+            values.append(value)
+        return HEADER.pack(self.version, mask) + layout.pack(*values)
+
+    def decode(self, data):
+        (version, mask) = HEADER.unpack_from(data)
+        if version != self.version:
+            raise ValueError(f'schéma v{version} inconnu (v{self.version} attendu)')
+        (layout, names, _) = self.layout(mask)
+        return dict(zip(names, layout.unpack_from(data, HEADER.size)))
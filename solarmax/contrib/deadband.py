@@ -0,0 +1,84 @@
+#
+# publication sur changement (bande morte)
+#
+'''
+Un message n'est publié que si un de ses champs a bougé au-delà de sa
+bande morte depuis la dernière publication, absolue (abs) ou en pourcentage
+(pct). Seuls les champs modifiés partent, accompagnés des clés
+d'identification; un instantané complet est envoyé au moins toutes les
+'heartbeat' secondes. Configuration (section solarmax):
+
+    deadband:
+      heartbeat: 300
+      fields:
+        pac: {abs: 20}
+        tmpr: {abs: 1}
+        qt0: {pct: 0.1}
+
+Un champ sans bande morte est publié dès que sa valeur change.
+'''
+import json, time, logging
+
+logger = logging.getLogger(__name__)
+
+
+class Deadband(object):
+
+    def __init__(self, fields=None, heartbeat=300, keys=('inv', 'host', 'time')):
+        self.fields = fields or {}
+        self.heartbeat = heartbeat
+        self.keys = keys                # toujours présentes dans un message partiel
+        self.__last = {}                # topic -> (valeurs publiées, date du dernier instantané)
+        self.counters = dict(full=0, partial=0, suppressed=0, suppressed_fields=0, suppressed_bytes=0)
+
+    def __repr__(self):
+        return 'Deadband[heartbeat=%ss / %i fields / %s]' % (self.heartbeat, len(self.fields), self.counters)
+
+    @classmethod
+    def from_config(cls, conf):
+        if not conf:
+            return None
+        return cls(conf.get('fields'), conf.get('heartbeat', 300))
+
+    def changed(self, field, value, last):
+        if last is None or not isinstance(value, (int, float)) or not isinstance(last, (int, float)):
+            return value != last
+        band = self.fields.get(field)
+        if band is None:
+            return value != last
+        if 'abs' in band:
+            return abs(value - last) > band['abs']
+        return abs(value - last) > abs(last) * band['pct'] / 100
+
+    def filter(self, topic, payload, now=None):
+        '''Message à publier pour ce topic (complet, partiel) ou None'''
+        now = now or time.monotonic()
+        entry = self.__last.get(topic)
+        if entry is None or now - entry[1] >= self.heartbeat:
+            self.__last[topic] = (dict(payload), now)
+            self.counters['full'] += 1
+            return dict(payload, full=True)
+
+        last = entry[0]
+        changes = {f: v for (f, v) in payload.items() if f not in self.keys and self.changed(f, v, last.get(f))}
+        if not changes:
+            self.counters['suppressed'] += 1
+            self.counters['suppressed_fields'] += len(payload)
+            self.counters['suppressed_bytes'] += len(json.dumps(payload, separators=(',', ':')))
+            return None
+        # la référence d'un champ est la dernière valeur publiée, pas la dernière lue
+        last.update(changes)
+        self.counters['partial'] += 1
+        message = {k: payload[k] for k in self.keys if k in payload}
+        self.counters['suppressed_fields'] += len(payload) - len(changes) - len(message)
+        message.update(changes, full=False)
+        return message
+
+    def reset(self, topic=None):
+        if topic is None:
+            self.__last.clear()
+        else:
+            self.__last.pop(topic, None)
+
+    def stats(self):
+        return dict(self.counters)
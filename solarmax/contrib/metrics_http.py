@@ -0,0 +1,105 @@
+#
+# exportateur OpenMetrics (Prometheus) servi depuis un instantané
+#
+'''
+La boucle d'interrogation appelle MetricsSnapshot.update() une fois par
+cycle: le texte OpenMetrics est produit à ce moment-là et gardé tel quel.
+Une lecture HTTP (GET /metrics) ne fait que renvoyer ces octets, sans
+aucune entrée/sortie vers les onduleurs et pour un coût indépendant du
+nombre d'onduleurs.
+'''
+import time, threading, logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def _value(v):
+    if v is None:
+        return 'NaN'
+    if isinstance(v, bool):
+        return '1' if v else '0'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class MetricsSnapshot(object):
+
+    def __init__(self, families):
+        '''families: [(nom, type, aide, clé du payload), ...] des métriques par onduleur'''
+        self.families = families
+        self.inverters = {}
+        self.body = b'# EOF\n'
+        self.updated = None
+        self.renders = 0
+
+    def __repr__(self):
+        return 'MetricsSnapshot[%i inverters / %i bytes]' % (len(self.inverters), len(self.body))
+
+    def update(self, payloads, health):
+        '''
+            payloads: messages 'production' du cycle (dernière valeur gardée par onduleur)
+            health: [(nom, type, aide, valeur), ...] état du démon
+        '''
+        for payload in payloads:
+            self.inverters.setdefault(payload['inv'], {}).update(payload)
+        lines = []
+        for (name, kind, help, key) in self.families:
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'# HELP {name} {help}')
+            sample = name + '_total' if kind == 'counter' else name
+            # numéros seuls, puis 'hôte:numéro' des numéros présents sur plusieurs hôtes
+            for (inv, values) in sorted(self.inverters.items(), key=lambda item: (isinstance(item[0], str), item[0])):
+                if key in values:
+                    lines.append(f'{sample}{{inv="{inv}"}} {_value(values[key])}')
+        for (name, kind, help, value) in health:
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f"{name + '_total' if kind == 'counter' else name} {_value(value)}")
+        lines.append('# EOF\n')
+        # remplacement atomique: un scrape voit l'ancien ou le nouvel instantané
+        self.body = '\n'.join(lines).encode('utf-8')
+        self.updated = time.time()
+        self.renders += 1
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    snapshot = None
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.snapshot.body
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class MetricsServer(object):
+
+    def __init__(self, snapshot, host='0.0.0.0', port=9108):
+        handler = type('SnapshotHandler', (MetricsHandler,), {'snapshot': snapshot})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __repr__(self):
+        return 'MetricsServer[%s:%s]' % self.httpd.server_address[:2]
+
+    def start(self):
+        self.thread.start()
+        logger.info(f'{self!r}: /metrics')
+        return self
+
+    def stop(self):
+        # shutdown() attend la fin de serve_forever: bloquerait si le thread n'a pas démarré
+        if self.thread.is_alive():
+            self.httpd.shutdown()
+        self.httpd.server_close()
@@ -1,7 +1,7 @@
 #
 # mqtt service
 #
-import json, time, logging, ssl
+import json, time, logging, ssl, threading
 import paho.mqtt.client as mqtt
 
 logging.basicConfig(level=logging.INFO)
@@ -16,12 +16,21 @@ class MqttBase(object):
         self.username       = p.get('username')
         self.password       = p.get('password')
         self.keepalive      = p.get('keepalive')
+        self.reconnect_timeout = p.get('reconnect_timeout', 120)
         self.use_ssl        = p.get('use_ssl', False)
         self.ca_cert        = p.get('ca_cert')
         self.tls_version    = p.get('tls_version', ssl.PROTOCOL_TLSv1_2)
         self.subscriptions  = [(topic, qos) for topic, qos in p.get('topic_subs', [])]
         self.unsubs         = self.client_get_unsubs()
         self.topic_base     = p.get('topic_base', '')
+        self.spool          = p.get('spool')
+        self.encoding       = p.get('encoding', 'json')
+        self.codec          = p.get('codec')
+        self.replay_rate    = p.get('replay_rate', 20)
+        self.connected      = False
+        self.replayer       = None
+        self.disconnected_at = time.monotonic()
+        self.link = dict(connects=0, disconnects=0, connect_failures=0, last_reconnect_latency=0.0, max_reconnect_latency=0.0, downtime=0.0)
 
         self.on_message_callback = p.get('on_messages', self._on_message_callback)
         self.on_bytes_callback = p.get('on_bytes', self._on_bytes_callback)
@@ -32,7 +41,10 @@ class MqttBase(object):
         if self.use_ssl and self.ca_cert:
             self.client.tls_set(ca_certs=self.ca_cert, tls_version=self.tls_version)
 
+        # la boucle réseau de paho se reconnecte seule, délai exponentiel de 1s à reconnect_timeout
+        self.client.reconnect_delay_set(min_delay=1, max_delay=self.reconnect_timeout)
         self.client.on_connect = self._on_connect
+        self.client.on_connect_fail = self._on_connect_fail
         self.client.on_disconnect = self._on_disconnect
         self.client.on_message = self._on_message
         self.client.on_log = self._on_log
@@ -62,6 +74,60 @@ class MqttBase(object):
             logger.error(e)
 
 
+    def _publish_batch(self, messages, qos=0, retain=False, spool=False, encoding=None):
+        '''messages: [(topic, payload dict), ...], chaque payload sérialisé une seule fois'''
+        encode = self._encoder(encoding or self.encoding)
+        # derrière un arriéré en file disque, les messages suivent pour garder l'ordre
+        spooling = spool and self.spool is not None and (not self.connected or self.spool.pending())
+        for (topic, payload) in messages:
+            try:
+                message = encode(payload)
+                if spooling:
+                    self.spool.append(topic, message, qos)
+                    continue
+                info = self.client.publish(topic, payload=message, qos=qos, retain=retain)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS and spool and self.spool is not None:
+                    spooling = True
+                    self.spool.append(topic, message, qos)
+            except Exception as e:
+                logger.error(f"\n    _publish_batch error: {topic} {e}")
+        if spooling and self.connected:
+            # broker présent: le rejeu vide la file, sinon elle ne ferait que grossir
+            self._start_replay()
+
+
+    def _encoder(self, encoding):
+        # 'struct': enregistrement binaire à plat (contrib.binpack), sinon json compact
+        if encoding == 'struct' and self.codec is not None:
+            return self.codec.encode
+        encode = json.JSONEncoder(separators=(',', ':')).encode
+        return lambda payload: encode(payload).encode('utf-8')
+
+
+    def _replay_one(self, topic, payload, qos):
+        return self.connected and self.client.publish(topic, payload=payload, qos=qos).rc == mqtt.MQTT_ERR_SUCCESS
+
+
+    def _replay_spool(self):
+        # rejoue la file disque à débit limité tant que le broker est là
+        wait = threading.Event().wait
+        try:
+            while self.connected and self.spool.pending():
+                count = self.spool.replay(self._replay_one, self.replay_rate)
+                logger.info(f"\n    spool: {count} messages rejoués, reste {self.spool.size()} octets")
+                wait(1)
+        except Exception as e:
+            logger.error(f"\n    _replay_spool error {e}")
+
+
+    def _start_replay(self):
+        if self.spool is None or not self.spool.pending():
+            return
+        if self.replayer is None or not self.replayer.is_alive():
+            self.replayer = threading.Thread(target=self._replay_spool, daemon=True)
+            self.replayer.start()
+
+
     def _publish_bytes(self, topic, payload, **conf):
         try:
             qos = conf.pop('qos', 0)
@@ -84,30 +150,44 @@ class MqttBase(object):
         try:
             if rc:
                 raise
+            self.__link_up()
             self.client_set_subscriptions()
             self._on_connect_info(msg)
+            self._start_replay()
         except Exception as e:
             logger.error(f"\n    _on_connect error {e}")
 
 
     def _on_disconnect(self, client, userdata, rc):
+        # pas de reconnexion ici: ce callback tourne dans la boucle réseau de paho
         logger.info(f"\n    Disconnected: {client._client_id} with status {rc}")
-        try:
-            j = 3
-            for i in range(j):
-                #client.unsubscribe(self.unsubs)
-                try:
-                    client.reconnect()
-                    break
-                except Exception as e:
-                    if i < j:
-                        logger.warn(e)
-                        time.sleep(1)
-                        continue
-                    else:
-                        raise
-        except Exception as e:
-            logger.error(f"\n    _on_disconnect error {e}")
+        if self.connected:
+            self.connected = False
+            self.disconnected_at = time.monotonic()
+            self.link['disconnects'] += 1
+
+
+    def _on_connect_fail(self, client, userdata):
+        self.link['connect_failures'] += 1
+        logger.debug(f"\n    connection to {self.host}:{self.port} failed")
+
+
+    def __link_up(self):
+        latency = time.monotonic() - self.disconnected_at
+        self.connected = True
+        self.link['downtime'] += latency
+        if self.link['connects']:
+            self.link['last_reconnect_latency'] = latency
+            self.link['max_reconnect_latency'] = max(self.link['max_reconnect_latency'], latency)
+        self.link['connects'] += 1
+
+
+    def link_stats(self):
+        '''Métriques de connexion au broker (délais en secondes)'''
+        stats = dict(self.link, connected=self.connected)
+        if not self.connected:
+            stats['downtime'] += time.monotonic() - self.disconnected_at
+        return stats
 
 
     def _on_stop_mqtt(self):
@@ -0,0 +1,160 @@
+#
+# agrégats glissants (1 min, 15 min, 1 h...) calculés au fil de l'eau
+#
+'''
+Chaque série (un onduleur ou la centrale) a un accumulateur par fenêtre,
+alignée sur l'horloge (une fenêtre de 900s commence à :00, :15...). Un
+échantillon coûte O(1): somme, min, max et intégration de l'énergie par
+la méthode des trapèzes. Un intervalle qui chevauche la fin d'une
+fenêtre est coupé à la frontière (valeur interpolée), chaque fenêtre
+reçoit sa part d'énergie. Un intervalle plus long que max_gap (arrêt du
+démon, panne de la passerelle) ne compte aucune énergie: la production
+pendant le trou est inconnue. Les fenêtres ouvertes sont sauvegardées
+dans un fichier JSON et reprises au redémarrage.
+'''
+import os, json, time, logging
+
+logger = logging.getLogger(__name__)
+
+
+def label(seconds):
+    if seconds % 3600 == 0:
+        return f'{seconds // 3600}h'
+    if seconds % 60 == 0:
+        return f'{seconds // 60}m'
+    return f'{seconds}s'
+
+
+class Window(object):
+    __slots__ = ('start', 'length', 'count', 'pac_sum', 'pac_min', 'pac_max', 'pdc_sum', 'energy',
+                 'tmpr_sum', 'tmpr_min', 'tmpr_max', 'last_t', 'last_pac')
+
+    def __init__(self, start, length):
+        self.start = start
+        self.length = length
+        self.count = 0
+        self.pac_sum = self.pdc_sum = self.energy = self.tmpr_sum = 0.0
+        self.pac_min = self.pac_max = self.tmpr_min = self.tmpr_max = None
+        self.last_t = self.last_pac = None
+
+    def __repr__(self):
+        return 'Window[%s+%s / n=%i / %.1f Wh]' % (self.start, label(self.length), self.count, self.energy)
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+    def integrate(self, t, pac, max_gap=None):
+        if self.last_t is not None and t > self.last_t and (max_gap is None or t - self.last_t <= max_gap):
+            self.energy += (self.last_pac + pac) / 2 * (t - self.last_t) / 3600
+        self.last_t, self.last_pac = t, pac
+
+    def add(self, t, pac, pdc, tmpr, max_gap=None):
+        self.integrate(t, pac, max_gap)
+        self.count += 1
+        self.pac_sum += pac
+        self.pdc_sum += pdc
+        self.tmpr_sum += tmpr
+        self.pac_min = pac if self.pac_min is None else min(self.pac_min, pac)
+        self.pac_max = pac if self.pac_max is None else max(self.pac_max, pac)
+        self.tmpr_min = tmpr if self.tmpr_min is None else min(self.tmpr_min, tmpr)
+        self.tmpr_max = tmpr if self.tmpr_max is None else max(self.tmpr_max, tmpr)
+
+    def result(self):
+        n = self.count or 1
+        return dict(
+            start=self.start,
+            end=self.end,
+            count=self.count,
+            pac_mean=round(self.pac_sum / n, 1),
+            pac_min=self.pac_min,
+            pac_max=self.pac_max,
+            energy_wh=round(self.energy, 2),
+            efficiency=round(100 * self.pac_sum / self.pdc_sum, 1) if self.pdc_sum else 0,
+            tmpr_mean=round(self.tmpr_sum / n, 1),
+            tmpr_min=self.tmpr_min,
+            tmpr_max=self.tmpr_max,
+        )
+
+    def state(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_state(cls, state):
+        window = cls(state['start'], state['length'])
+        for (k, v) in state.items():
+            setattr(window, k, v)
+        return window
+
+
+class Rollup(object):
+
+    def __init__(self, windows=(60, 900, 3600), state_file=None, save_interval=60, max_gap=None):
+        self.windows = tuple(windows)
+        self.state_file = state_file
+        self.max_gap = max_gap
+        self.save_interval = save_interval
+        self.saved = 0.0
+        self.__open = {}            # (série, longueur) -> Window
+        self.closed = 0
+        self.gaps = 0
+        self.load()
+
+    def __repr__(self):
+        return 'Rollup[%s / %i open / %i closed / %i gaps]' % (','.join(label(w) for w in self.windows), len(self.__open), self.closed, self.gaps)
+
+    def add(self, key, t, pac, pdc, tmpr):
+        '''Ajoute un échantillon; retourne [(label, série, résultat), ...] des fenêtres fermées'''
+        closed = []
+        for length in self.windows:
+            window = self.__open.get((key, length))
+            gap = window is not None and window.last_t is not None and self.max_gap is not None and t - window.last_t > self.max_gap
+            if gap and length == self.windows[0]:
+                logger.info(f'rollup {key}: {t - window.last_t:.0f}s sans échantillon, énergie non intégrée')
+                self.gaps += 1
+            if window is not None and t >= window.end:
+                # part de l'intervalle avant la frontière, valeur interpolée
+                if window.last_t is not None and t > window.last_t and not gap:
+                    boundary = window.last_pac + (pac - window.last_pac) * (window.end - window.last_t) / (t - window.last_t)
+                    window.integrate(window.end, boundary)
+                    carry = (window.end, boundary)
+                else:
+                    carry = None
+                closed.append((label(length), key, window.result()))
+                self.closed += 1
+                window = None
+            else:
+                carry = None
+            if window is None:
+                window = self.__open[(key, length)] = Window(t - t % length, length)
+                if carry and carry[0] == window.start:
+                    # l'autre part de l'intervalle revient à la nouvelle fenêtre
+                    (window.last_t, window.last_pac) = carry
+            window.add(t, pac, pdc, tmpr, self.max_gap)
+        return closed
+
+    def load(self):
+        if not self.state_file:
+            return
+        try:
+            with open(self.state_file) as f:
+                state = json.load(f)
+            for entry in state:
+                key = entry['key']
+                window = Window.from_state(entry['window'])
+                if window.length in self.windows:
+                    self.__open[(key, window.length)] = window
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f'rollup: état {self.state_file} illisible, ignoré: {e}')
+
+    def save(self, force=False):
+        now = time.monotonic()
+        if not self.state_file or (not force and now - self.saved < self.save_interval):
+            return
+        self.saved = now
+        state = [dict(key=key, window=window.state()) for ((key, _), window) in self.__open.items()]
+        with open(self.state_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.state_file + '.tmp', self.state_file)
@@ -0,0 +1,173 @@
+#
+# file d'attente disque (store-and-forward) pour les coupures mqtt
+#
+'''
+Les messages qui ne peuvent pas partir (broker absent) sont ajoutés à la
+fin de fichiers segments <n>.seg d'un répertoire; index.json garde la
+position de relecture (segment, offset). Après reconnexion, les messages
+sont rejoués dans l'ordre, à débit limité, et un segment entièrement
+relu est supprimé. La taille totale et l'âge des segments sont bornés:
+les plus anciens sont évincés en premier. Rien n'est gardé en mémoire,
+une coupure de plusieurs heures ne coûte que de l'espace disque.
+
+Enregistrement: en-tête struct '>IdHB' (taille du message, horodatage,
+taille du topic, qos) suivi du topic et du message.
+'''
+import os, json, time, struct, threading, logging
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct('>IdHB')
+
+
+class Spool(object):
+
+    def __init__(self, directory, segment_size=1 << 20, max_bytes=64 << 20, max_age=7 * 86400):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.__lock = threading.RLock()
+        self.__writer = None
+        self.counters = dict(spooled=0, replayed=0, evicted_segments=0, evicted_bytes=0)
+        os.makedirs(directory, exist_ok=True)
+        self.__segments = sorted(int(f[:-4]) for f in os.listdir(directory) if f.endswith('.seg'))
+        self.__position = self.__load_index()
+
+    def __repr__(self):
+        return 'Spool[%s / %i segments / %i bytes]' % (self.directory, len(self.__segments), self.size())
+
+    def __path(self, segment):
+        return os.path.join(self.directory, '%012i.seg' % segment)
+
+    def __load_index(self):
+        try:
+            with open(os.path.join(self.directory, 'index.json')) as f:
+                index = json.load(f)
+            position = (index['segment'], index['offset'])
+        except (OSError, ValueError, KeyError):
+            position = (self.__segments[0] if self.__segments else 0, 0)
+        if self.__segments and position[0] < self.__segments[0]:
+            position = (self.__segments[0], 0)
+        return position
+
+    def __save_index(self):
+        path = os.path.join(self.directory, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(dict(segment=self.__position[0], offset=self.__position[1]), f)
+        os.replace(path + '.tmp', path)
+
+    def __close_writer(self):
+        if self.__writer:
+            self.__writer.close()
+            self.__writer = None
+
+    def __remove(self, segment, evicted=False):
+        path = self.__path(segment)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            size = 0
+        self.__segments.remove(segment)
+        if evicted:
+            self.counters['evicted_segments'] += 1
+            self.counters['evicted_bytes'] += size
+
+    def size(self):
+        with self.__lock:
+            total = 0
+            for segment in self.__segments:
+                try:
+                    total += os.path.getsize(self.__path(segment))
+                except OSError:
+                    pass
+            return max(total - self.__position[1], 0)
+
+    def pending(self):
+        with self.__lock:
+            if not self.__segments:
+                return False
+            (segment, offset) = self.__position
+            return segment < self.__segments[-1] or offset < os.path.getsize(self.__path(segment))
+
+    def append(self, topic, payload, qos=0, now=None):
+        topic = topic.encode('utf-8')
+        record = RECORD.pack(len(payload), now or time.time(), len(topic), qos) + topic + payload
+        with self.__lock:
+            if self.__writer is None or self.__writer.tell() >= self.segment_size:
+                self.__close_writer()
+                segment = self.__segments[-1] + 1 if self.__segments else self.__position[0]
+                self.__segments.append(segment)
+                self.__writer = open(self.__path(segment), 'ab')
+            self.__writer.write(record)
+            self.__writer.flush()
+            self.counters['spooled'] += 1
+            self.evict()
+
+    def evict(self, now=None):
+        '''Supprime les segments les plus anciens au-delà de max_bytes ou de max_age'''
+        now = now or time.time()
+        with self.__lock:
+            while len(self.__segments) > 1:
+                oldest = self.__segments[0]
+                path = self.__path(oldest)
+                if self.size() <= self.max_bytes and now - os.path.getmtime(path) <= self.max_age:
+                    break
+                logger.warning(f'spool: segment {path} évincé')
+                self.__remove(oldest, evicted=True)
+                if self.__position[0] <= oldest:
+                    self.__position = (self.__segments[0], 0)
+                    self.__save_index()
+
+    def replay(self, publish, limit=100):
+        '''
+            Rejoue au plus limit messages dans l'ordre avec publish(topic, payload, qos).
+            publish retourne False pour interrompre (broker de nouveau absent).
+            Retourne le nombre de messages rejoués.
+        '''
+        count = 0
+        with self.__lock:
+            while count < limit and self.__segments:
+                (segment, offset) = self.__position
+                if segment not in self.__segments:
+                    segment, offset = self.__segments[0], 0
+                eof = False
+                with open(self.__path(segment), 'rb') as f:
+                    f.seek(offset)
+                    while count < limit:
+                        header = f.read(RECORD.size)
+                        if len(header) < RECORD.size:
+                            eof = True
+                            break
+                        (size, _, topic_size, qos) = RECORD.unpack(header)
+                        topic = f.read(topic_size).decode('utf-8')
+                        payload = f.read(size)
+                        if not publish(topic, payload, qos):
+                            self.__save_index()
+                            return count
+                        count += 1
+                        self.counters['replayed'] += 1
+                        self.__position = (segment, f.tell())
+                if not eof:
+                    break
+                if segment != self.__segments[-1]:
+                    # segment entièrement relu
+                    self.__remove(segment)
+                    self.__position = (self.__segments[0], 0)
+                else:
+                    # tout est relu: on repart sur un segment neuf
+                    self.__close_writer()
+                    self.__remove(segment)
+                    self.__position = (segment + 1, 0)
+                    break
+            self.__save_index()
+        return count
+
+    def close(self):
+        with self.__lock:
+            self.__close_writer()
+            self.__save_index()
+
+    def stats(self):
+        return dict(self.counters, segments=len(self.__segments), bytes=self.size())
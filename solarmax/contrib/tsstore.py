@@ -0,0 +1,194 @@
+#
+# stockage local en colonnes (fichiers mmap) des échantillons des onduleurs
+#
+'''
+Un répertoire par jour, par hôte et par onduleur (le numéro 1 existe sur
+chaque hôte à un seul onduleur), un fichier par colonne de largeur fixe
+(format array/struct):
+
+    store/20261018/192.168.1.123/1/time.col   uint32, secondes
+    store/20261018/192.168.1.123/1/pac.col    float32
+    ...
+
+Les fichiers sont projetés en mémoire (mmap); une écriture ne touche que
+la ligne ajoutée. Le nombre de lignes n'est écrit nulle part: les
+horodatages sont croissants et la fin de fichier est à zéro, une
+recherche dichotomique le retrouve à l'ouverture. Les fichiers grandissent
+par doublement. Une requête sur un intervalle ne lit que les pages
+concernées et retourne des memoryview (numpy.frombuffer(view, view.format)
+sans copie).
+'''
+import os, mmap, time, shutil, logging
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = (
+    ('time', 'I'), ('pac', 'f'), ('udc', 'f'), ('idc', 'f'), ('uac', 'f'), ('iac', 'f'),
+    ('tkk', 'h'), ('kdy', 'f'), ('kt0', 'I'), ('sys', 'H'),
+)
+SIZES = {'I': 4, 'f': 4, 'h': 2, 'H': 2, 'd': 8, 'q': 8}
+
+
+def _count(times, size):
+    '''Nombre de lignes écrites: premier horodatage nul'''
+    (lo, hi) = (0, size)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if times[mid]:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class Segment(object):
+    '''Colonnes d'un onduleur pour un jour, ouvertes en écriture'''
+
+    def __init__(self, path, columns, capacity):
+        self.path = path
+        self.columns = columns
+        os.makedirs(path, exist_ok=True)
+        self.files = {}
+        self.maps = {}
+        self.views = {}
+        for (name, fmt) in columns:
+            filename = os.path.join(path, name + '.col')
+            f = open(filename, 'r+b' if os.path.exists(filename) else 'w+b')
+            if os.fstat(f.fileno()).st_size == 0:
+                f.truncate(capacity * SIZES[fmt])
+            self.files[name] = f
+        self.__map()
+        self.count = _count(self.views['time'], self.capacity)
+
+    def __repr__(self):
+        return 'Segment[%s / %i/%i rows]' % (self.path, self.count, self.capacity)
+
+    def __map(self):
+        for (name, fmt) in self.columns:
+            m = self.maps[name] = mmap.mmap(self.files[name].fileno(), 0)
+            self.views[name] = memoryview(m).cast(fmt)
+        self.capacity = min(len(v) for v in self.views.values())
+
+    def __unmap(self):
+        for name in list(self.views):
+            self.views.pop(name).release()
+            self.maps.pop(name).close()
+
+    def grow(self):
+        capacity = self.capacity * 2
+        self.__unmap()
+        for (name, fmt) in self.columns:
+            self.files[name].truncate(capacity * SIZES[fmt])
+        self.__map()
+
+    def append(self, values):
+        if self.count >= self.capacity:
+            self.grow()
+        n = self.count
+        for (name, fmt) in self.columns:
+            value = values.get(name)
+            self.views[name][n] = (0 if fmt in 'IhHq' else float('nan')) if value is None else (int(value) if fmt in 'IhHq' else value)
+        self.count = n + 1
+
+    def close(self):
+        for m in self.maps.values():
+            m.flush()
+        self.__unmap()
+        for f in self.files.values():
+            f.close()
+
+
+class ColumnStore(object):
+
+    def __init__(self, directory, columns=COLUMNS, capacity=17280, retention=None):
+        self.directory = directory
+        self.columns = columns
+        self.capacity = capacity        # lignes allouées au départ: une journée à 5s
+        self.retention = retention      # jours gardés, None: tout
+        self.__segments = {}            # (hôte, onduleur) -> (jour, Segment)
+        self.appended = 0
+
+    def __repr__(self):
+        return 'ColumnStore[%s / %i open segments]' % (self.directory, len(self.__segments))
+
+    @staticmethod
+    def day(timestamp):
+        return time.strftime('%Y%m%d', time.localtime(timestamp))
+
+    def path(self, day, host, inverter):
+        return os.path.join(self.directory, day, host, str(inverter))
+
+    def append(self, host, inverter, timestamp, values):
+        '''Ajoute une ligne; values: {colonne: valeur}, 'time' est fourni par timestamp'''
+        day = self.day(timestamp)
+        entry = self.__segments.get((host, inverter))
+        if entry is None or entry[0] != day:
+            if entry is not None:
+                # rotation journalière
+                entry[1].close()
+                self.expire()
+            entry = self.__segments[(host, inverter)] = (day, Segment(self.path(day, host, inverter), self.columns, self.capacity))
+        segment = entry[1]
+        if segment.count and timestamp < segment.views['time'][segment.count - 1]:
+            logger.warning(f'{segment!r}: horodatage {timestamp} antérieur à la dernière ligne, ignoré')
+            return
+        values = dict(values, time=int(timestamp))
+        segment.append(values)
+        self.appended += 1
+
+    def days(self):
+        try:
+            return sorted(d for d in os.listdir(self.directory) if d.isdigit())
+        except FileNotFoundError:
+            return []
+
+    def expire(self):
+        if not self.retention:
+            return
+        for day in self.days()[:-self.retention]:
+            logger.info(f'tsstore: suppression du jour {day}')
+            shutil.rmtree(os.path.join(self.directory, day), ignore_errors=True)
+
+    def __read(self, path, name, fmt):
+        with open(os.path.join(path, name + '.col'), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return memoryview(b'').cast(fmt)
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(fmt)
+
+    def query(self, host, inverter, start, end, columns=None):
+        '''
+            Lignes de start <= time < end, jour par jour:
+            [(jour, {colonne: memoryview}), ...] sans copie des données
+        '''
+        formats = dict(self.columns)
+        names = ['time'] + [c for c in (columns or formats) if c != 'time']
+        (first, last) = (self.day(start), self.day(end))
+        result = []
+        for day in self.days():
+            if not first <= day <= last:
+                continue
+            path = self.path(day, host, inverter)
+            if not os.path.isdir(path):
+                continue
+            times = self.__read(path, 'time', 'I')
+            count = _count(times, len(times))
+            lo = bisect_left(times, start, 0, count)
+            hi = bisect_left(times, end, lo, count)
+            if lo == hi:
+                continue
+            chunk = {'time': times[lo:hi]}
+            for name in names[1:]:
+                chunk[name] = self.__read(path, name, formats[name])[lo:hi]
+            result.append((day, chunk))
+        return result
+
+    def flush(self):
+        for (_, segment) in self.__segments.values():
+            for m in segment.maps.values():
+                m.flush()
+
+    def close(self):
+        for (_, segment) in self.__segments.values():
+            segment.close()
+        self.__segments.clear()
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+# -* coding: utf-8 *-
+'''
+Mode multi-processus: un superviseur répartit la table `inverters` entre
+N processus d'interrogation (solarmax.processes dans la configuration).
+
+Chaque processus (ShardWorker) interroge ses hôtes avec la boucle normale
+du démon, synchrone ou asynchrone, et envoie à chaque cycle ses messages
+au superviseur par une multiprocessing.Queue (pickle sur un tube). Le
+superviseur (ShardSupervisor) est le seul à publier: il attend un cycle
+de chaque processus vivant, fusionne les messages et les publie comme un
+cycle ordinaire (mqtt, bande morte, file disque, agrégats, /metrics). Un
+processus qui meurt est relancé, avec un délai croissant s'il recommence.
+'''
+import os, time, queue, logging, threading, multiprocessing
+from solarmaxd import SolarmaxDaemon
+from SolarMax.connection import Backoff
+from SolarMax.instrumentation import Histogram, CYCLE_BOUNDS, ERRORS
+
+logger = logging.getLogger(__name__)
+
+
+def split_hosts(inverters, n):
+    '''Répartit {hôte: [onduleurs]} en n parts équilibrées par nombre d'onduleurs'''
+    shards = [{} for _ in range(max(n, 1))]
+    load = [0] * len(shards)
+    for host in sorted(inverters, key=lambda h: len(inverters[h]), reverse=True):
+        i = min(range(len(shards)), key=lambda i: (load[i], len(shards[i])))
+        shards[i][host] = inverters[host]
+        load[i] += len(inverters[host])
+    return [shard for shard in shards if shard]
+
+
+class ShardWorker(SolarmaxDaemon):
+    '''Interrogation d'une part des hôtes, sans publication: tout part vers le superviseur'''
+
+    def __init__(self, shard, channel, conf_file, **settings):
+        self.shard = shard
+        self.channel = channel
+        self.parent = os.getppid()
+        super().__init__(conf_file, **settings)
+
+    def __repr__(self):
+        return 'ShardWorker[%i / %i hosts / pid %i]' % (self.shard, len(self.inverters), os.getpid())
+
+    def setup_publishing(self):
+        self.mqtt = None
+        self.rollup = None
+        self.metrics = None
+        self.metrics_server = None
+        self.deadband = None
+        self.spool = None
+
+    def stop_publishing(self):
+        pass
+
+    def start(self):
+        logger.info(f'{self!r}: {list(self.inverters)}')
+        self.run()
+
+    def publish_cycle(self, count, payloads):
+        self.cycles += 1
+        self.channel.put(('cycle', self.shard, count, payloads, self.last_cycle_duration, self.protocol_errors(), self.scheduler.stats()))
+        if os.getppid() != self.parent:
+            # superviseur disparu: personne ne lit plus la file
+            logger.error(f'{self!r}: superviseur disparu, arrêt')
+            self.solar_stop.set()
+
+    def publish_alarms(self, host, inverter, events):
+        self.channel.put(('alarms', self.shard, host, inverter, events))
+
+    def publish_stats(self):
+        now = time.monotonic()
+        if now - self.stats_published < self.stats_interval:
+            return
+        self.stats_published = now
+        self.channel.put(('stats', self.shard, self.host_stats()))
+
+
+def worker_main(shard, channel, conf_file, settings):
+    '''Point d'entrée d'un processus d'interrogation (contexte spawn)'''
+    worker = None
+    try:
+        worker = ShardWorker(shard, channel, conf_file, **settings)
+        worker.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if worker:
+            worker.stop()
+
+
+class ShardState(object):
+    '''Vue du superviseur sur un processus d'interrogation'''
+
+    def __init__(self, shard, inverters):
+        self.shard = shard
+        self.inverters = inverters
+        self.size = sum(len(v) for v in inverters.values())
+        self.process = None
+        self.backoff = Backoff(initial=1.0, maximum=60.0)
+        self.restarts = 0
+        self.cycles = 0
+        self.count = 0
+        self.cycle_duration = Histogram(CYCLE_BOUNDS)
+        self.errors = dict.fromkeys(ERRORS, 0)
+        self.scheduler = {}
+        self.hosts = {}
+
+    def __repr__(self):
+        return 'ShardState[%i / %i inverters / pid %s / %i restarts]' % (self.shard, self.size, self.process and self.process.pid, self.restarts)
+
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def stats(self):
+        return dict(
+            pid=self.process and self.process.pid,
+            alive=self.alive(),
+            hosts=list(self.inverters),
+            inverters=self.size,
+            cycles=self.cycles,
+            restarts=self.restarts,
+            cycle=self.cycle_duration.snapshot(),
+        )
+
+
+class ShardSupervisor(SolarmaxDaemon):
+    '''Lance les processus d'interrogation, les relance et publie leurs cycles'''
+
+    def __repr__(self):
+        return 'ShardSupervisor[%i shards / %i inverters]' % (len(self.shards), self.inverters_size)
+
+    def setup_polling(self):
+        # les connexions, l'inventaire et l'historique local sont dans les processus
+        self.inventory = None
+        self.register_cache = None
+        self.alarms = None
+        self.ondemand = self.writer = None
+        self.ondemand_event = threading.Event()
+        self.scheduler = None
+        self.store = None
+        self.smlist = []
+        self.asmlist = []
+        self.context = multiprocessing.get_context('spawn')
+        self.channel = self.context.Queue()
+        processes = self.settings['solarmax'].get('processes', 1)
+        if self.settings['solarmax'].get('ondemand'):
+            # les connexions sont dans les processus d'interrogation: rien pour servir /get et /set ici
+            logger.warning(f'solarmax.ondemand ignoré avec processes={processes}: /get et /set désactivés')
+        self.shards = [ShardState(n, inverters) for (n, inverters) in enumerate(split_hosts(self.inverters, processes))]
+
+    def worker_settings(self, state):
+        solarmax = dict(self.settings['solarmax'], inverters=state.inverters, http_port=None, processes=1, ondemand=None)
+        if solarmax.get('inventory_file'):
+            # un fichier par processus: deux processus n'écrivent jamais le même
+            solarmax['inventory_file'] = f"{solarmax['inventory_file']}.{state.shard}"
+        if (solarmax.get('alarms') or {}).get('state_file'):
+            solarmax['alarms'] = dict(solarmax['alarms'], state_file=f"{solarmax['alarms']['state_file']}.{state.shard}")
+        if solarmax.get('store'):
+            # fichiers mmap et expiration (rmtree) propres à chaque processus
+            solarmax['store'] = dict(solarmax['store'], directory=f"{solarmax['store'].get('directory', 'store')}.{state.shard}")
+        return dict(self.settings, solarmax=solarmax)
+
+    def spawn(self, state):
+        state.process = self.context.Process(
+            target=worker_main, name=f'solarmax-shard-{state.shard}',
+            args=(state.shard, self.channel, self.conf_file, self.worker_settings(state)), daemon=True,
+        )
+        state.process.start()
+        logger.info(f'{state!r}: {list(state.inverters)}')
+
+    def supervise(self):
+        for state in self.shards:
+            if state.alive() or self.solar_stop.is_set():
+                continue
+            if state.process is not None and not state.backoff.ready():
+                continue
+            if state.process is not None:
+                logger.error(f'{state!r}: terminé (code {state.process.exitcode}), relance')
+                state.restarts += 1
+                state.backoff.failure()
+                state.count = 0
+            self.spawn(state)
+
+    def receive(self, message, fresh):
+        (kind, shard) = message[:2]
+        state = self.shards[shard]
+        if kind == 'stats':
+            state.hosts = message[2]
+            return
+        if kind == 'alarms':
+            self.publish_alarms(*message[2:])
+            return
+        (count, payloads, duration, errors, scheduler) = message[2:]
+        state.cycles += 1
+        state.count = count
+        state.errors = errors
+        state.scheduler = scheduler
+        state.cycle_duration.observe(duration)
+        state.backoff.success()
+        # un processus en avance sur les autres: seul son dernier cycle compte
+        fresh[shard] = (payloads, duration)
+
+    def collect(self):
+        '''Messages d'un cycle de chaque processus vivant, au plus host_timeout + loop_timeout'''
+        fresh = {}
+        deadline = time.monotonic() + self.timeout + self.host_timeout
+        while not self.solar_stop.is_set():
+            alive = [state.shard for state in self.shards if state.alive()]
+            if alive and all(shard in fresh for shard in alive):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self.receive(self.channel.get(timeout=min(remaining, 1.0)), fresh)
+            except queue.Empty:
+                self.supervise()
+        return fresh
+
+    def run(self):
+        self.run_forever()
+
+    def run_forever(self):
+        logger.info(f'{self!r}::run_forever is started')
+        self.supervise()
+        while not self.solar_stop.is_set():
+            try:
+                fresh = self.collect()
+                self.supervise()
+                if fresh:
+                    # la durée d'un cycle de la centrale est celle du processus le plus lent
+                    self.last_cycle_duration = max(duration for (_, duration) in fresh.values())
+                    self.cycle_duration.observe(self.last_cycle_duration)
+                    payloads = [p for (shard_payloads, _) in fresh.values() for p in shard_payloads]
+                    self.publish_cycle(sum(state.count for state in self.shards), payloads)
+            except Exception as e:
+                self.cycle_errors += 1
+                logger.error(e)
+            self.publish_stats()
+
+    def stop(self):
+        self.solar_stop.set()
+        self.stop_publishing()
+        for state in self.shards:
+            if state.alive():
+                state.process.terminate()
+        for state in self.shards:
+            if state.process is not None:
+                state.process.join(5)
+
+    def host_stats(self):
+        hosts = {}
+        for state in self.shards:
+            hosts.update(state.hosts)
+        return hosts
+
+    def scheduler_stats(self):
+        stats = {}
+        for state in self.shards:
+            for (k, v) in state.scheduler.items():
+                stats[k] = stats.get(k, 0) + v
+        return stats or dict(registers_saved=0)
+
+    def protocol_errors(self):
+        errors = dict.fromkeys(ERRORS, 0)
+        for state in self.shards:
+            for (kind, n) in state.errors.items():
+                errors[kind] += n
+        return errors
+
+    def health_metrics(self, count):
+        health = super().health_metrics(count)
+        health.append(('solarmax_shards_alive', 'gauge', "Processus d'interrogation actifs", sum(1 for s in self.shards if s.alive())))
+        health.append(('solarmax_shard_restarts', 'counter', "Relances de processus d'interrogation", sum(s.restarts for s in self.shards)))
+        return health
+
+    def stats(self):
+        stats = super().stats()
+        stats['shards'] = {state.shard: state.stats() for state in self.shards}
+        return stats
@@ -5,9 +5,22 @@ Created on 7 nov. 2023
 
 @author: denis
 '''
-import threading, logging, argparse
+import threading, logging, argparse, asyncio, time
 from SolarMax.solarmax_fr import SolarMax, get_status_code
+from SolarMax.async_solarmax import AsyncSolarMax
+from SolarMax.inventory import Inventory
+from SolarMax.scheduler import RegisterScheduler
+from SolarMax.instrumentation import Histogram, CYCLE_BOUNDS, ERRORS
+from SolarMax.regcache import RegisterCache
+from SolarMax.ondemand import OnDemandReader, OnDemandWriter
+from SolarMax.alarms import AlarmHistory, EC_REGISTERS
 from contrib.mqttc import MqttBase
+from contrib.deadband import Deadband
+from contrib.spool import Spool
+from contrib.binpack import StructCodec
+from contrib.metrics_http import MetricsSnapshot, MetricsServer
+from contrib.tsstore import ColumnStore
+from contrib.rollup import Rollup
 from contrib import utils
 
 
@@ -22,6 +35,20 @@ INVERTERS = {
     #'192.168.0.204': [4,],
 }
 
+def inverter_labels(inverters):
+    '''
+        Nom publié de chaque onduleur {(hôte, numéro): nom}: son numéro,
+        ou 'hôte:numéro' quand ce numéro existe sur plusieurs hôtes
+    '''
+    hosts = {}
+    for host in inverters:
+        for no in inverters[host]:
+            hosts.setdefault(no, []).append(host)
+    return {(host, no): no if len(hosts[no]) == 1 else f'{host}:{no}' for (no, names) in hosts.items() for host in names}
+
+
+POLL_VALUES = ['PAC', 'TKK', 'KDY', 'KT0', 'IDC', 'UDC', 'IL1', 'UL1', 'FDAT', 'SYS']
+
 ACCESS = [
     (1, "Pub only"),
     (2, "/set only"),
@@ -29,11 +56,46 @@ ACCESS = [
     (7, "/get, /set, pub"),
 ]
 
+# champs publiés; 'pack' donne leur format dans l'encodage binaire (contrib.binpack)
+DATAS = [
+    {"access":1,"description":"Linux timestamp en secondes","label":"Timestamp","name":"time","property":"time","type":"numeric","pack":"I","unit":"s"},
+    {"access":1,"description":"Numéro d'onduleur","label":"Inverter","name":"inv","property":"range","type":"numeric","pack":"B","unit":""},
+    {"access":1,"description":"Hôte (passerelle) de l'onduleur","label":"Host","name":"host","property":"address","type":"text","unit":""},
+    {"access":1,"description":"Intensité max","label":"Ivmax","name":"ivmax","property":"intensity","type":"numeric","pack":"H","unit":"A"},
+    {"access":1,"description":"Production AC","label":"PAC","name":"pac","property":"power","type":"numeric","pack":"f","unit":"W"},
+    {"access":1,"description":"Rendement AC","label":"Eac","name":"eac","property":"efficiency","type":"numeric","pack":"H","unit":""},
+    {"access":1,"description":"Production DC.","label":"PDC","name":"pdc","property":"power","type":"numeric","pack":"f","unit":"W"},
+    {"access":1,"description":"Efficacity DC","label":"Edc","name":"edc","property":"efficiency","type":"numeric","pack":"H","unit":""},
+    {"access":1,"description":"Production du jour","label":"Qday","name":"qdy","property":"days","type":"numeric","pack":"f","unit":"kWh"},
+    {"access":1,"description":"Production totale","label":"Qtotal","name":"qt0","property":"days","type":"numeric","pack":"I","unit":"kWh"},
+    {"access":1,"description":"Status onduleur","label":"Status","name":"stat","property":"state","type":"text","pack":"H","unit":""},
+    {"access":1,"description":"Température des panneaux","label":"Temperature","name":"tmpr","property":"temperature","type":"numeric","pack":"b","unit":"°C"},
+    {"access":1,"description":"Onduleurs agrégés (centrale)","label":"Count","name":"count","property":"range","type":"numeric","pack":"H","unit":""},
+    {"access":1,"description":"Température min (centrale)","label":"Tmin","name":"tmin","property":"temperature","type":"numeric","pack":"b","unit":"°C"},
+    {"access":1,"description":"Température max (centrale)","label":"Tmax","name":"tmax","property":"temperature","type":"numeric","pack":"b","unit":"°C"},
+    {"access":1,"description":"Instantané complet (bande morte)","label":"Full","name":"full","property":"state","type":"bool","pack":"?","unit":""},
+]
+
+# métriques OpenMetrics par onduleur: (nom, type, aide, champ du message 'production')
+METRIC_FAMILIES = [
+    ('solarmax_ac_power_watts', 'gauge', 'Production AC (W)', 'pac'),
+    ('solarmax_dc_power_watts', 'gauge', 'Production DC (W)', 'pdc'),
+    ('solarmax_ac_yield_percent', 'gauge', 'Rendement AC (% de la puissance installée)', 'eac'),
+    ('solarmax_dc_efficiency_percent', 'gauge', 'Efficacité DC (%)', 'edc'),
+    ('solarmax_energy_today_kwh', 'gauge', 'Production du jour (kWh)', 'qdy'),
+    ('solarmax_energy_kwh', 'counter', 'Production totale (kWh)', 'qt0'),
+    ('solarmax_temperature_celsius', 'gauge', 'Température des panneaux (°C)', 'tmpr'),
+    ('solarmax_status_code', 'gauge', 'Status onduleur (SYS)', 'stat'),
+    ('solarmax_last_sample_timestamp_seconds', 'gauge', 'Date de la dernière lecture', 'time'),
+]
+
+
 class SolarmaxMqttWorker(MqttBase):
 
     def __init__(self, parent=None, **p):
         super().__init__(**p)
         self.parent = parent
+        self.deadband = p.get('deadband')
 
     def makeReport(self):
         data = dict(
@@ -45,19 +107,9 @@ class SolarmaxMqttWorker(MqttBase):
             description = "Onduleur Solarmax SM2000S, 1980 W",
             ip = self.parent.ip,
             org = self.parent.org,
-            datas = [
-                {"access":1,"description":"Linux timestamp en secondes","label":"Timestamp","name":"time","property":"time","type":"numeric","unit":"s"},
-                {"access":1,"description":"Numéro d'onduleur","label":"Inverter","name":"inv","property":"range","type":"numeric","unit":""},
-                {"access":1,"description":"Intensité max","label":"Ivmax","name":"ivmax","property":"intensity","type":"numeric","unit":"A"},
-                {"access":1,"description":"Production AC","label":"PAC","name":"pac","property":"power","type":"numeric","unit":"W"},
-                {"access":1,"description":"Rendement AC","label":"Eac","name":"eac","property":"efficiency","type":"numeric","unit":""},
-                {"access":1,"description":"Production DC.","label":"PDC","name":"pdc","property":"power","type":"numeric","unit":"W"},
-                {"access":1,"description":"Efficacity DC","label":"Edc","name":"edc","property":"efficiency","type":"numeric","unit":""},
-                {"access":1,"description":"Production du jour","label":"Qday","name":"qdy","property":"days","type":"numeric","unit":"kWh"},
-                {"access":1,"description":"Production totale","label":"Qtotal","name":"qt0","property":"days","type":"numeric","unit":"kWh"},
-                {"access":1,"description":"Status onduleur","label":"Status","name":"stat","property":"state","type":"text","unit":""},
-                {"access":1,"description":"Température des panneaux","label":"Temperature","name":"tmpr","property":"temperature","type":"numeric","unit":"°C"},
-            ],
+            encoding = self.encoding,
+            schema = self.codec.version if self.codec else None,
+            datas = DATAS,
         )
         return data
 
@@ -67,6 +119,24 @@ class SolarmaxMqttWorker(MqttBase):
         self._publish_message(f'{self.topic_base}/{evt}', **payload)
 
 
+    def publish_batch(self, messages):
+        # messages: [(evt, payload), ...] d'un même cycle
+        messages = [(f'{self.topic_base}/{evt}', payload) for (evt, payload) in messages]
+        if self.deadband is not None:
+            messages = [(topic, payload) for (topic, payload) in ((t, self.deadband.filter(t, p)) for (t, p) in messages) if payload]
+        self._publish_batch(messages, spool=True)
+
+
+    def publish_rollups(self, messages):
+        # agrégats: toujours en json, sans bande morte, mis en file disque si besoin
+        self._publish_batch([(f'{self.topic_base}/{evt}', payload) for (evt, payload) in messages], spool=True, encoding='json')
+
+
+    def publish_alarms(self, events):
+        # nouvelles entrées de l'historique des erreurs, comme les agrégats
+        self._publish_batch([(f'{self.topic_base}/alarms', event) for event in events], spool=True, encoding='json')
+
+
     def _on_stop_mqtt(self):
         self.publish_to_client('stop', alive=False)
         logger.info(f'WAITING 1s for last message')
@@ -75,12 +145,24 @@ class SolarmaxMqttWorker(MqttBase):
 
     def _on_connect_info(self, info):
         logger.info(f"{info}\n    subs: {self.subscriptions}")
+        if self.deadband is not None:
+            # instantanés complets après une (re)connexion au broker
+            self.deadband.reset()
         self.publish_to_client('report', retain=True, **self.makeReport())
 
 
     def _on_message_callback(self, topic, payload):
         try:
-            pass
+            # topic_base/<inv>/<action>, <inv> étant le nom publié ('1' ou 'hôte:1');
+            # nos propres publications passent aussi par ici
+            parts = topic[len(self.topic_base) + 1:].split('/') if topic.startswith(self.topic_base + '/') else []
+            if len(parts) != 2:
+                return
+            (name, action) = parts
+            if action == 'get':
+                self.parent.request_registers(name, payload)
+            elif action == 'set':
+                self.parent.request_settings(name, payload)
             #if topic.endswith('registry'):
             #    self.publish_to_client('report', **self.makeReport())
 
@@ -88,78 +170,174 @@ class SolarmaxMqttWorker(MqttBase):
             logger.error(e)
 
 
+    def _on_bytes_callback(self, topic, payload):
+        # demande en texte brut: 'PAC,SYS'
+        self._on_message_callback(topic, payload.decode('utf-8', 'replace'))
+
+
 class SolarmaxDaemon():
 
     def __init__(self, conf_file, **settings):
         super().__init__()
         self.conf_file = conf_file
         self.settings = settings
-        topic_subs = self.settings['solarmax']['topic_subs']
-        topic_base = self.settings['solarmax']['topic_base']
         inverters = self.settings['solarmax']['inverters']
         self.timeout = self.settings['solarmax']['loop_timeout']
         self.uuid = hex(self.settings['solarmax']['uuid'])
         self.ip =  self.settings['solarmax']['ip']
         self.org =  self.settings['solarmax']['origine']
+        self.port = self.settings['solarmax'].get('port', 12345)
+        self.use_async = self.settings['solarmax'].get('async', False)
+        self.host_timeout = self.settings['solarmax'].get('host_timeout', 15)
+        self.pipeline_window = self.settings['solarmax'].get('pipeline_window', 1)
+        self.inverters = inverters
+        self.labels = inverter_labels(inverters)
+        self.addresses = {str(label): key for (key, label) in self.labels.items()}
         self.solar_stop = threading.Event()
 
-        self.smlist = []
-        for host in inverters.keys():
-            sm = SolarMax(host, 12345)
-            sm.use_inverters(inverters[host])
-            self.smlist.append(sm)
-
         self.allinverters = []
         for host in inverters.keys():
             self.allinverters.extend(inverters[host])
 
         self.inverters_size = len(self.allinverters)
-        self.mqtt = SolarmaxMqttWorker(parent=self, topic_base=topic_base ,topic_subs=topic_subs, **settings['mqtt'])
+        self.cycles = 0
+        self.cycle_errors = 0
+        self.cycle_duration = Histogram(CYCLE_BOUNDS)
+        self.last_cycle_duration = 0.0
+        self.stats_interval = self.settings['solarmax'].get('stats_interval', 60)
+        self.stats_published = time.monotonic()
+        self.setup_polling()
+        self.setup_publishing()
+
+
+    def setup_polling(self):
+        # interrogation des onduleurs: connexions, inventaire, ordonnanceur, historique local
+        inventory_file = self.settings['solarmax'].get('inventory_file')
+        self.inventory = Inventory(inventory_file, self.settings['solarmax'].get('inventory_ttl', 86400)) if inventory_file else None
+        self.scheduler = RegisterScheduler.from_config(self.settings['solarmax'].get('schedule'), POLL_VALUES)
+        alarms = self.settings['solarmax'].get('alarms')
+        self.alarms = AlarmHistory(alarms.get('state_file')) if alarms else None
+        if self.alarms is not None:
+            # historique des erreurs: son propre groupe, lu rarement
+            self.scheduler.add_group(alarms.get('interval', 3600), EC_REGISTERS)
+        store = self.settings['solarmax'].get('store')
+        self.store = ColumnStore(store.get('directory', 'store'), retention=store.get('retention')) if store else None
+        register_cache = self.settings['solarmax'].get('register_cache')
+        self.register_cache = RegisterCache(register_cache.get('ttl', 2), register_cache.get('ttls')) if register_cache else None
+        ondemand = self.settings['solarmax'].get('ondemand')
+        self.ondemand = self.writer = None
+        self.ondemand_event = threading.Event()
+        if ondemand:
+            # un seul cache quand les deux sont configurés
+            cache = self.register_cache or RegisterCache(ondemand.get('ttl', 5))
+            self.ondemand = OnDemandReader(cache, self.publish_values, ondemand.get('max_registers', 16), self.ondemand_event)
+            self.writer = OnDemandWriter(cache, self.publish_written, ondemand.get('write_interval', 2), ondemand.get('writable'),
+                                         ondemand.get('max_registers', 16), self.ondemand_event)
+        self.smlist = []
+        self.asmlist = []
+        if not self.use_async:
+            for host in self.inverters.keys():
+                sm = SolarMax(host, self.port, inventory=self.inventory, register_cache=self.register_cache)
+                sm.pipeline.window = self.pipeline_window
+                sm.use_inverters(self.inverters[host])
+                self.smlist.append(sm)
+
+
+    def setup_publishing(self):
+        # publication: mqtt, bande morte, file disque, agrégats, métriques http
+        topic_subs = self.settings['solarmax']['topic_subs']
+        topic_base = self.settings['solarmax']['topic_base']
+        rollup = self.settings['solarmax'].get('rollup')
+        # au-delà de quelques cycles sans échantillon (redémarrage, panne), pas d'intégration
+        max_gap = rollup.get('max_gap', max(5 * self.timeout, 60)) if rollup else None
+        self.rollup = Rollup(rollup.get('windows', (60, 900, 3600)), rollup.get('state_file'), max_gap=max_gap) if rollup else None
+        self.metrics = None
+        self.metrics_server = None
+        if self.settings['solarmax'].get('http_port'):
+            self.metrics = MetricsSnapshot(METRIC_FAMILIES)
+            self.metrics_server = MetricsServer(self.metrics, self.settings['solarmax'].get('http_host', '0.0.0.0'), self.settings['solarmax']['http_port'])
+        self.deadband = Deadband.from_config(self.settings['solarmax'].get('deadband'))
+        self.spool = self.make_spool(self.settings['solarmax'].get('spool'))
+        codec = StructCodec(DATAS) if self.settings['mqtt'].get('encoding') == 'struct' else None
+        self.mqtt = SolarmaxMqttWorker(
+            parent=self, topic_base=topic_base ,topic_subs=topic_subs, deadband=self.deadband, codec=codec,
+            spool=self.spool, replay_rate=(self.settings['solarmax'].get('spool') or {}).get('replay_rate', 20), **self.settings['mqtt']
+        )
         self.mqtt.connectMQTT()
 
 
+    def make_spool(self, conf):
+        # file disque des messages 'production' pendant les coupures du broker
+        if not conf:
+            return None
+        return Spool(
+            conf.get('directory', 'spool'),
+            segment_size=conf.get('segment_size', 1 << 20),
+            max_bytes=conf.get('max_bytes', 64 << 20),
+            max_age=conf.get('max_age', 7 * 86400),
+        )
+
+
     def start(self):
         self.mqtt.client.loop_start()
-        self.run_forever()
+        if self.metrics_server:
+            self.metrics_server.start()
+        self.run()
+
+
+    def run(self):
+        if self.use_async:
+            asyncio.run(self.run_async())
+        else:
+            self.run_forever()
 
 
     def stop(self):
-        self.mqtt.client.loop_stop()
         self.solar_stop.set()
+        self.ondemand_event.set()
+        self.stop_publishing()
+        if self.store is not None:
+            self.store.close()
 
 
-    def run_forever(self):
-        logger.info(f'Module SolarmaxDaemon::run_forever is started')
-        while not self.solar_stop.is_set():
-            try:
-                count = 0
-                for sm in self.smlist:
-                    for (no, ivdata) in sm.inverters().items():
-                        try:
-                            (inverter, current) = sm.query(no, ['PAC', 'TKK', 'KDY', 'KT0', 'IDC', 'UDC', 'IL1', 'UL1', 'FDAT', 'SYS'])
-                            count += 1
-                        except:
-                            logger.info(f'Erreur de communication, éventuellement onduleur éteint, WR {no}')
-                            threading.Event().wait(self.timeout)
-                            continue
-                        ivmax = ivdata['installed']
-                        ivname = ivdata['desc']
-                        UAC = current['UL1']
-                        IAC = current['IL1']
-                        PAC = UAC * IAC
-                        IDC = current['IDC']
-                        UDC = current['UDC']
-                        tmpr = current['TKK']
-                        eac = int((PAC/ivmax) * 100)        # rendement AC
-                        PDC = UDC * IDC
-                        edc = int((float(PAC)/PDC) * 100)   # efficacity DC
-
-                        (status, errors) = sm.status(no)
-                        if errors:
-                            logger.error(f'WR {no}: {status} ({errors})')
-                            continue
-
-                        logger.debug(
+    def stop_publishing(self):
+        self.mqtt.client.loop_stop()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.spool is not None:
+            self.spool.close()
+        if self.rollup is not None:
+            self.rollup.save(force=True)
+
+
+    def record(self, host, inverter, current):
+        # historique local, indépendant du broker
+        self.store.append(host, inverter, utils.ts_now(), dict(
+            pac=current.PAC, udc=current.UDC, idc=current.IDC, uac=current.UL1, iac=current.IL1,
+            tkk=current.TKK, kdy=current.KDY, kt0=current.KT0, sys=current.SYS[0],
+        ))
+
+
+    def make_payload(self, host, inverter, ivdata, current, status, errors):
+        if self.store is not None:
+            self.record(host, inverter, current)
+        ivmax = ivdata['installed']
+        ivname = ivdata['desc']
+        UAC = current.UL1
+        IAC = current.IL1
+        PAC = UAC * IAC
+        IDC = current.IDC
+        UDC = current.UDC
+        tmpr = current.TKK
+        eac = int((PAC/ivmax) * 100)        # rendement AC
+        PDC = UDC * IDC
+        edc = int((float(PAC)/PDC) * 100) if PDC else 0   # efficacity DC
+
+        if errors:
+            logger.error(f'WR {inverter}: {status} ({errors})')
+            return None
+
+        logger.debug(
 f'''
     Onduleur..............: n° {inverter} ({ivname})
     Status................: {status}
@@ -168,32 +346,480 @@ f'''
     Intensité CC..........: {IDC} A
     Tension AC............: {UAC} V
     Intensité AC..........: {IAC} A
-    Production AC.........: {current['PAC']:9.1f} Watt / calculée: {PAC:9.1f} W  rendement: ({eac}% de {ivmax} Watt)
+    Production AC.........: {current.PAC:9.1f} Watt / calculée: {PAC:9.1f} W  rendement: ({eac}% de {ivmax} Watt)
     Production DC.........: {PDC:9.1f} Watt (Efficacité: {edc}%)
-    Total aujourd'hui.....: {current['KDY']:9.1f} kWh
-    Total jusqu'à présent.: {current['KT0']:9.1f} kWh (depuis le {current['FDAT'].date()})
+    Total aujourd'hui.....: {current.KDY:9.1f} kWh
+    Total jusqu'à présent.: {current.KT0:9.1f} kWh (depuis le {current.FDAT.date()})
 '''
-                        )
-                if count < self.inverters_size:
-                    raise Exception(f"({count} < {self.inverters_size} => Erreur de communication, éventuellement onduleur éteint")
-
-                payload = dict(
-                    time=utils.ts_now(),
-                    inv=inverter,
-                    ivmax=ivmax,
-                    tmpr=tmpr,
-                    pac=round(PAC, 1),
-                    eac=eac,
-                    pdc=round(PDC, 1),
-                    edc=edc,
-                    qdy=current['KDY'],
-                    qt0=current['KT0'],
-                    stat=get_status_code(status),
-                )
-                self.mqtt.publish_to_client('production', **payload)
+        )
+        return dict(
+            inv=inverter,
+            host=host,
+            ivmax=ivmax,
+            tmpr=tmpr,
+            pac=round(PAC, 1),
+            eac=eac,
+            pdc=round(PDC, 1),
+            edc=edc,
+            qdy=current.KDY,
+            qt0=current.KT0,
+            stat=get_status_code(status),
+        )
+
+
+    def plant_payload(self, payloads):
+        # agrégat de la centrale sur les onduleurs qui ont répondu pendant le cycle
+        tmpr = [p['tmpr'] for p in payloads]
+        return dict(
+            count=len(payloads),
+            pac=round(sum(p['pac'] for p in payloads), 1),
+            pdc=round(sum(p['pdc'] for p in payloads), 1),
+            qdy=round(sum(p['qdy'] for p in payloads), 1),
+            qt0=sum(p['qt0'] for p in payloads),
+            tmin=min(tmpr),
+            tmax=max(tmpr),
+        )
+
+
+    def health_metrics(self, count):
+        link = self.mqtt.link_stats()
+        health = [
+            ('solarmax_inverters_configured', 'gauge', 'Onduleurs configurés', self.inverters_size),
+            ('solarmax_inverters_polled', 'gauge', 'Onduleurs lus au dernier cycle', count),
+            ('solarmax_cycles', 'counter', "Cycles d'interrogation", self.cycles),
+            ('solarmax_cycle_timestamp_seconds', 'gauge', 'Date du dernier cycle', utils.ts_now()),
+            ('solarmax_mqtt_connected', 'gauge', 'Connexion au broker', link['connected']),
+            ('solarmax_mqtt_reconnects', 'counter', 'Reconnexions au broker', max(link['connects'] - 1, 0)),
+            ('solarmax_mqtt_downtime_seconds', 'counter', 'Durée cumulée sans broker', link['downtime']),
+            ('solarmax_registers_saved', 'counter', "Registres non lus grâce à l'ordonnanceur", self.scheduler_stats()['registers_saved']),
+            ('solarmax_cycle_duration_seconds', 'gauge', "Durée du dernier cycle d'interrogation", self.last_cycle_duration),
+            ('solarmax_cycle_errors', 'counter', 'Cycles en erreur', self.cycle_errors),
+        ]
+        errors = self.protocol_errors()
+        health.extend((f'solarmax_protocol_{kind}_errors', 'counter', f'Erreurs protocole: {kind}', errors[kind]) for kind in ERRORS)
+        if self.deadband is not None:
+            health.append(('solarmax_messages_suppressed', 'counter', 'Messages retenus par la bande morte', self.deadband.counters['suppressed']))
+        if self.spool is not None:
+            health.append(('solarmax_spool_bytes', 'gauge', 'Octets en attente dans la file disque', self.spool.size()))
+        if self.alarms is not None:
+            health.append(('solarmax_alarm_events', 'counter', "Nouvelles entrées de l'historique des erreurs", self.alarms.counters['events']))
+        if self.register_cache is not None:
+            health.append(('solarmax_register_cache_hit_ratio', 'gauge', 'Registres servis par le cache', self.register_cache.stats()['hit_ratio']))
+        if self.ondemand is not None:
+            health.append(('solarmax_ondemand_requests', 'counter', 'Lectures à la demande (/get)', self.ondemand.counters['requests']))
+            health.append(('solarmax_ondemand_cache_hit_ratio', 'gauge', 'Registres /get servis par le cache', self.ondemand.cache.stats()['hit_ratio']))
+            health.append(('solarmax_ondemand_writes', 'counter', 'Écritures confirmées (/set)', self.writer.counters['confirmed']))
+            health.append(('solarmax_ondemand_write_latency_seconds', 'gauge', "Durée moyenne d'une trame d'écriture", self.writer.latency.mean()))
+        return health
+
+
+    def instrumented(self):
+        return [sm.instruments for sm in self.smlist or self.asmlist]
+
+
+    def protocol_errors(self):
+        errors = dict.fromkeys(ERRORS, 0)
+        for instruments in self.instrumented():
+            for (kind, n) in instruments.errors.items():
+                errors[kind] += n
+        return errors
+
+
+    def host_stats(self):
+        return {sm.connection.host if self.smlist else sm.host: sm.stats() for sm in self.smlist or self.asmlist}
+
+
+    def scheduler_stats(self):
+        return self.scheduler.stats()
+
+
+    def observe_cycle(self, started):
+        self.last_cycle_duration = time.monotonic() - started
+        self.cycle_duration.observe(self.last_cycle_duration)
+
+
+    def stats(self):
+        '''Latences, erreurs et compteurs du démon, interrogeables en cours de route'''
+        stats = dict(
+            time=utils.ts_now(),
+            cycles=self.cycles,
+            cycle_errors=self.cycle_errors,
+            cycle=self.cycle_duration.snapshot(),
+            errors=self.protocol_errors(),
+            hosts=self.host_stats(),
+            mqtt=self.mqtt.link_stats(),
+            scheduler=self.scheduler_stats(),
+        )
+        if self.deadband is not None:
+            stats['deadband'] = self.deadband.stats()
+        if self.spool is not None:
+            stats['spool'] = self.spool.stats()
+        if self.register_cache is not None:
+            stats['register_cache'] = self.register_cache.stats()
+        if self.alarms is not None:
+            stats['alarms'] = self.alarms.stats()
+        if self.ondemand is not None:
+            stats['ondemand'] = self.ondemand.stats()
+            stats['writes'] = self.writer.stats()
+        return stats
+
+
+    def publish_stats(self):
+        now = time.monotonic()
+        if now - self.stats_published < self.stats_interval:
+            return
+        self.stats_published = now
+        self.mqtt.publish_to_client('stats', **self.stats())
+
+
+    def label(self, host, inverter):
+        '''Nom publié d'un onduleur: topics, étiquettes des métriques, séries des agrégats'''
+        return self.labels.get((host, inverter), inverter)
+
+
+    def publish_rollups(self, payloads, plant):
+        closed = []
+        for p in payloads:
+            closed.extend(self.rollup.add(self.label(p['host'], p['inv']), p['time'], p['pac'], p['pdc'], p['tmpr']))
+        closed.extend(self.rollup.add('plant', plant['time'], plant['pac'], plant['pdc'], plant['tmax']))
+        if closed:
+            self.mqtt.publish_rollups([(f'rollup/{window}', dict(result, inv=key)) for (window, key, result) in closed])
+        self.rollup.save()
+
+
+    def publish_cycle(self, count, payloads):
+        # un seul horodatage par cycle, un message par onduleur et l'agrégat
+        self.cycles += 1
+        now = utils.ts_now()
+        payloads = [dict(p, time=now) for p in payloads]
+        if payloads:
+            plant = dict(self.plant_payload(payloads), time=now)
+            messages = [(f"production/{self.label(p['host'], p['inv'])}", p) for p in payloads]
+            messages.append(('production/plant', plant))
+            self.mqtt.publish_batch(messages)
+            if self.rollup is not None:
+                self.publish_rollups(payloads, plant)
+        if self.metrics is not None:
+            self.metrics.update([dict(p, inv=self.label(p['host'], p['inv'])) for p in payloads], self.health_metrics(count))
+        if count < self.inverters_size:
+            raise Exception(f"({count} < {self.inverters_size} => Erreur de communication, éventuellement onduleur éteint")
+
+
+    def publish_values(self, host, inverter, payload):
+        self.mqtt.publish_to_client(f'{self.label(host, inverter)}/values', **payload)
+
+
+    def request_registers(self, name, payload):
+        '''Demande /get (thread mqtt): {"values": [...], "id": ...}, [...] ou 'PAC,SYS' '''
+        if self.ondemand is None or name not in self.addresses:
+            return
+        (host, inverter) = self.addresses[name]
+        (values, request_id) = (payload.get('values'), payload.get('id')) if isinstance(payload, dict) else (payload, None)
+        self.ondemand.request(host, inverter, values if isinstance(values, (list, str)) else [], request_id)
+
+
+    def publish_written(self, host, inverter, payload):
+        self.mqtt.publish_to_client(f'{self.label(host, inverter)}/written', **payload)
+
+
+    def request_settings(self, name, payload):
+        '''Demande /set (thread mqtt): {"values": {registre: valeur}, "id": ...} ou {registre: valeur}'''
+        if self.writer is None or name not in self.addresses:
+            return
+        (host, inverter) = self.addresses[name]
+        if isinstance(payload, dict) and isinstance(payload.get('values'), dict):
+            self.writer.request(host, inverter, payload['values'], payload.get('id'))
+        else:
+            self.writer.request(host, inverter, payload)
+
+
+    def fresh_sample(self, host, inverter, sample):
+        '''Registres qui viennent d'être lus, avant leur fusion par l'ordonnanceur'''
+        # les lectures régulières alimentent aussi le cache des lectures à la demande
+        if self.ondemand is not None and self.ondemand.cache is not self.register_cache:
+            self.ondemand.cache.update(host, inverter, sample)
+        if self.alarms is not None:
+            events = self.alarms.diff(host, inverter, sample)
+            if events:
+                self.publish_alarms(host, inverter, events)
+
+
+    def publish_alarms(self, host, inverter, events):
+        now = utils.ts_now()
+        for event in events:
+            logger.warning(f"{host} WR {inverter}: {event['register']} {event['date']} {', '.join(event['alarms']) or event['code']}")
+        self.mqtt.publish_alarms([dict(event, inv=inverter, host=host, time=now) for event in events])
+
+
+    def connector(self, host):
+        for sm in self.smlist:
+            if sm.connection.host == host:
+                return sm
+        for asm in self.asmlist:
+            if asm.host == host:
+                return asm
+        return None
+
+
+    def serve_ondemand(self, limit=None):
+        '''Lectures puis écritures à la demande en attente, au plus limit trames en tout'''
+        if self.ondemand is None:
+            return
+        demands = self.ondemand.take(limit)
+        for demand in demands:
+            values = self.ondemand.missing(demand)
+            sm = self.connector(demand.host)
+            result = None
+            if not values:
+                result = (demand.inverter, {})
+            elif sm is not None and sm.available(demand.inverter):
+                try:
+                    result = sm.query(demand.inverter, values)
+                except Exception as e:
+                    logger.info(f'WR {demand.inverter}: lecture à la demande en erreur: {e}')
+            self.ondemand.complete(demand, result[1] if result else None)
+        # les écritures se partagent ce qui reste du budget
+        for demand in self.writer.take(None if limit is None else limit - len(demands)):
+            sm = self.connector(demand.host)
+            (result, started) = (None, time.monotonic())
+            if sm is not None and sm.available(demand.inverter):
+                try:
+                    result = sm.write_setting(demand.inverter, demand.values)
+                except Exception as e:
+                    logger.info(f'WR {demand.inverter}: écriture en erreur: {e}')
+            self.writer.complete(demand, result[1] if result else None, time.monotonic() - started)
+
+
+    def ondemand_delay(self):
+        '''0: demandes à servir, None: rien en attente, sinon secondes avant la prochaine écriture permise'''
+        if self.ondemand.pending():
+            return 0.0
+        return self.writer.delay()
+
+
+    def idle_wait(self, timeout):
+        '''Attente entre deux cycles, interrompue pour servir les demandes /get et /set'''
+        if self.ondemand is None:
+            threading.Event().wait(timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while not self.solar_stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            delay = self.ondemand_delay()
+            if delay == 0:
+                self.serve_ondemand()
+                continue
+            self.ondemand_event.wait(remaining if delay is None else min(delay, remaining))
+            self.ondemand_event.clear()
+
+
+    def poll_host(self, sm):
+        # les onduleurs muets ne sont réinterrogés qu'après leur délai de reprise
+        inverters = {no: ivdata for (no, ivdata) in sm.inverters().items() if sm.available(no)}
+        if self.pipeline_window > 1 and len(inverters) > 1:
+            return self.poll_host_pipelined(sm, inverters)
+        host = sm.connection.host
+        count, payloads = 0, []
+        for (no, ivdata) in inverters.items():
+            values = self.scheduler.due((host, no))
+            if not values:
+                count += 1
+                continue
+            try:
+                (inverter, current, status, errors) = sm.poll(no, values)
+                count += 1
+            except:
+                self.scheduler.failure((host, no))
+                logger.info(f'Erreur de communication, éventuellement onduleur éteint, WR {no}')
+                threading.Event().wait(self.timeout)
+                continue
+            self.fresh_sample(host, no, current)
+            current = self.scheduler.update((host, no), current)
+            payload = self.make_payload(host, inverter, ivdata, current, status, errors)
+            if payload:
+                payloads.append(payload)
+        return count, payloads
+
+
+    def poll_host_pipelined(self, sm, inverters):
+        host = sm.connection.host
+        count, payloads = 0, []
+        # une passe de pipeline par jeu de registres échus
+        batches = {}
+        for no in inverters:
+            values = self.scheduler.due((host, no))
+            if values:
+                batches.setdefault(tuple(values), []).append(no)
+            else:
+                count += 1
+        for (values, batch) in batches.items():
+            results = sm.poll_many(batch, values)
+            for no in batch:
+                result = results.get(no)
+                if not result:
+                    self.scheduler.failure((host, no))
+                    logger.info(f'Erreur de communication, éventuellement onduleur éteint, WR {no}')
+                    continue
+                count += 1
+                (inverter, current, status, errors) = result
+                self.fresh_sample(host, no, current)
+                current = self.scheduler.update((host, no), current)
+                payload = self.make_payload(host, inverter, inverters[no], current, status, errors)
+                if payload:
+                    payloads.append(payload)
+        logger.debug(f"{sm!r}: {sm.pipeline.stats['rps']:.1f} requêtes/s")
+        return count, payloads
+
+
+    def poll_cycle(self):
+        count, payloads = 0, []
+        for sm in self.smlist:
+            (n, p) = self.poll_host(sm)
+            count += n
+            payloads.extend(p)
+            # revalidation paresseuse de l'inventaire, un onduleur par hôte et par cycle
+            sm.revalidate()
+            # une trame à la demande au plus (lecture ou écriture) entre deux hôtes
+            self.serve_ondemand(limit=1)
+        return count, payloads
+
+
+    def run_forever(self):
+        logger.info(f'Module SolarmaxDaemon::run_forever is started')
+        while not self.solar_stop.is_set():
+            try:
+                started = time.monotonic()
+                result = self.poll_cycle()
+                self.observe_cycle(started)
+                self.publish_cycle(*result)
+            except Exception as e:
+                self.cycle_errors += 1
+                logger.error(e)
+            self.publish_stats()
+            self.idle_wait(self.timeout)
+
+
+    async def poll_host_async(self, asm):
+        count, payloads = 0, []
+        for (no, ivdata) in (await asm.inverters()).items():
+            # comme en synchrone: un onduleur muet attend son délai de reprise
+            if not asm.available(no):
+                continue
+            values = self.scheduler.due((asm.host, no))
+            if not values:
+                count += 1
+                continue
+            try:
+                result = await asm.poll(no, values)
+            except Exception as e:
+                # trame illisible: seul cet onduleur manque au cycle
+                self.scheduler.failure((asm.host, no))
+                logger.info(f'Hôte {asm.host}, WR {no}: réponse en erreur: {e!r}')
+                continue
+            if not result:
+                self.scheduler.failure((asm.host, no))
+                logger.info(f'Erreur de communication, éventuellement onduleur éteint, WR {no}')
+                continue
+            (inverter, current, status, errors) = result
+            count += 1
+            self.fresh_sample(asm.host, no, current)
+            current = self.scheduler.update((asm.host, no), current)
+            payload = self.make_payload(asm.host, inverter, ivdata, current, status, errors)
+            if payload:
+                payloads.append(payload)
+        await asm.revalidate()
+        return count, payloads
+
+
+    async def bounded(self, asm, coro):
+        # un hôte lent ou mort ne retient pas le cycle au-delà de host_timeout
+        try:
+            return await asyncio.wait_for(coro, self.host_timeout)
+        except asyncio.TimeoutError:
+            logger.info(f'Hôte {asm.host}: pas de réponse en {self.host_timeout}s')
+            await asm.close()
+        return 0, []
+
+
+    async def connect_async(self):
+        self.asmlist = [AsyncSolarMax(host, self.port, inventory=self.inventory, register_cache=self.register_cache) for host in self.inverters.keys()]
+        await asyncio.gather(*(self.bounded(asm, asm.use_inverters(self.inverters[asm.host])) for asm in self.asmlist))
+
+
+    async def serve_ondemand_async(self, limit=None):
+        if self.ondemand is None:
+            return
+        demands = self.ondemand.take(limit)
+        for demand in demands:
+            values = self.ondemand.missing(demand)
+            asm = self.connector(demand.host)
+            result = None
+            if not values:
+                result = (demand.inverter, {})
+            elif asm is not None and asm.available(demand.inverter):
+                try:
+                    result = await asyncio.wait_for(asm.query(demand.inverter, values), self.host_timeout)
+                except Exception as e:
+                    logger.info(f'WR {demand.inverter}: lecture à la demande en erreur: {e!r}')
+            self.ondemand.complete(demand, result[1] if result else None)
+        for demand in self.writer.take(None if limit is None else limit - len(demands)):
+            asm = self.connector(demand.host)
+            (result, started) = (None, time.monotonic())
+            if asm is not None and asm.available(demand.inverter):
+                try:
+                    result = await asyncio.wait_for(asm.write_setting(demand.inverter, demand.values), self.host_timeout)
+                except Exception as e:
+                    logger.info(f'WR {demand.inverter}: écriture en erreur: {e!r}')
+            self.writer.complete(demand, result[1] if result else None, time.monotonic() - started)
+
+
+    async def idle_wait_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        if self.ondemand is None:
+            await loop.run_in_executor(None, self.solar_stop.wait, timeout)
+            return
+        deadline = time.monotonic() + timeout
+        while not self.solar_stop.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            delay = self.ondemand_delay()
+            if delay == 0:
+                await self.serve_ondemand_async()
+                continue
+            await loop.run_in_executor(None, self.ondemand_event.wait, remaining if delay is None else min(delay, remaining))
+            self.ondemand_event.clear()
+
+
+    async def poll_cycle_async(self):
+        count, payloads = 0, []
+        results = await asyncio.gather(*(self.bounded(asm, self.poll_host_async(asm)) for asm in self.asmlist), return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(result)
+                continue
+            count += result[0]
+            payloads.extend(result[1])
+        return count, payloads
+
+
+    async def run_async(self):
+        logger.info(f'Module SolarmaxDaemon::run_async is started')
+        await self.connect_async()
+        while not self.solar_stop.is_set():
+            try:
+                started = time.monotonic()
+                result = await self.poll_cycle_async()
+                self.observe_cycle(started)
+                self.publish_cycle(*result)
             except Exception as e:
+                self.cycle_errors += 1
                 logger.error(e)
-            threading.Event().wait(self.timeout)
+            self.publish_stats()
+            await self.idle_wait_async(self.timeout)
+        await asyncio.gather(*(asm.close() for asm in self.asmlist))
 
 
 def load_configuration(conf_file):
@@ -213,7 +839,11 @@ def main(conf_file):
     daemon = None
     try:
         config = load_configuration(conf_file)
-        daemon = SolarmaxDaemon(conf_file, **config)
+        if config['solarmax'].get('processes', 1) > 1:
+            from sharding import ShardSupervisor
+            daemon = ShardSupervisor(conf_file, **config)
+        else:
+            daemon = SolarmaxDaemon(conf_file, **config)
         daemon.start()
 
     except Exception as e: